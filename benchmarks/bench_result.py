@@ -0,0 +1,103 @@
+"""Cost of merging and serializing the Results of a large rubric.
+
+usage: python benchmarks/bench_result.py [--rules N] [--objects N] [--repeat N]
+
+Every rule is applied to every object, like per_module rules are, and the per-object
+results are merged into one result per rule, then the rule results into the result of
+the student, like CompoundRule does. Each rule also adds a few KiB of custom output, like
+the COMPILATION_* entries. The merge is compared to the previous implementation, which
+deep-copied in __add__ and rebuilt the custom dict on every +=.
+"""
+import argparse
+import os
+import pickle
+import sys
+import time
+
+from copy import deepcopy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from grader.result import Result
+
+
+class LegacyResult:
+    def __init__(self, need_review=True):
+        self.penalty = 0
+        self.messages = []
+        self.comments = []
+        self.custom = {}
+        self.need_review = need_review
+
+    def __iadd__(self, other):
+        self.penalty += other.penalty
+        self.messages += other.messages
+        self.comments += other.comments
+        self.custom = {**self.custom, **other.custom}
+        self.need_review |= other.need_review
+        return self
+
+    def __add__(self, other):
+        res = deepcopy(self)
+        res += other
+        return res
+
+
+def object_result(cls, rule, obj):
+    res = cls(need_review=False)
+    res.penalty = 1
+    res.messages = [f"obj{obj}.c: message {i} of rule {rule}" for i in range(3)]
+    res.comments = [f"comment of rule {rule}"]
+    res.custom = {f"RULE{rule}_obj{obj}": f"output of rule {rule} for obj{obj}\n" * 128}
+    return res
+
+
+def grade(cls, rules, objects, use_add):
+    total = cls(need_review=False)
+    for rule in range(rules):
+        rule_res = cls(need_review=False)
+        for obj in range(objects):
+            rule_res += object_result(cls, rule, obj)
+        if use_add:
+            total = total + rule_res
+        else:
+            total += rule_res
+    return total
+
+
+def best_of(repeat, func):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rules", type=int, default=40)
+    parser.add_argument("--objects", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{args.rules} rules x {args.objects} objects, best of {args.repeat}")
+    for name, cls in [("legacy", LegacyResult), ("slots", Result)]:
+        for op, use_add in [("+=", False), ("+", True)]:
+            t = best_of(args.repeat, lambda: grade(cls, args.rules, args.objects, use_add))
+            print(f"{name:<8} merge with {op:<3} {t * 1000:>9.2f} ms")
+
+    res = grade(Result, args.rules, args.objects, False)
+    data = res.to_json()
+    pickled = pickle.dumps(res)
+    print(f"to_json               {best_of(args.repeat, res.to_json) * 1000:>9.2f} ms, {len(data)} bytes")
+    print(f"from_json             {best_of(args.repeat, lambda: Result.from_json(data)) * 1000:>9.2f} ms")
+    print(f"pickle round trip     {best_of(args.repeat, lambda: pickle.loads(pickle.dumps(res))) * 1000:>9.2f} ms, "
+          f"{len(pickled)} bytes")
+
+    assert Result.from_json(data).to_json() == data
+    assert pickle.loads(pickled).to_json() == data
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,56 @@
 from grader.rules.rule import construct_rule
-from grader.project import Project
+from grader.project import Project, set_content_budget
+from grader.result import Result
 from grader.review.reviewer import construct_reviewer
 
+import grader.cache as cache
+import grader.engine as engine
+import grader.profiling as profiling
 import grader.storage as storage
 
+from grader.cache import hash_key
+from grader.distributed import Coordinator, run_worker
+
 import argparse
+import asyncio
 import json
+import os
 from plumbum import local
 
 from threading import Thread
 from queue import Queue
 from functools import partial
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import time
 
 
 class ReviewApp:
-    def __init__(self, config, rule_config, project_config):
+    def __init__(self, config, rule_config, project_config, incremental=False, profile=False, headless=False):
         self.rule = construct_rule({"name": "compound", "config": rule_config})
         self.project_config = project_config
         self.project_root_template = config["project_root_template"]
         self.tag = config.get("review_tag", None)
         self.run_async = config.get("async", True)
         self.run_queue_limit = config.get("async_queue_limit", 10)
-
-        self.reviewer = construct_reviewer(config["reviewer"]["name"], config["reviewer"]["config"])
-
-        storage.init_storage(config["storage_path"])
+        self.workers = config.get("workers", 1)
+        self.prefetch = config.get("review_prefetch", 0)
+        self.rule_config = rule_config
+        self.incremental = incremental
+        self.rule_config_hash = hash_key(json.dumps(rule_config, sort_keys=True))
+
+        # Batch mode only grades, so it must not depend on an editor being available
+        self.reviewer = None if headless else construct_reviewer(config["reviewer"]["name"], config["reviewer"]["config"])
+
+        storage.init_storage(config["storage_path"], config.get("storage_compact_every", 100))
+        cache.init_cache(config.get("cache", {}))
+        self.file_memory_limit = config.get("file_memory_mb", 256) * 1024 * 1024
+        set_content_budget(self.file_memory_limit)
+        profiling.init_profiler(profile)
+        self.engine_config = config.get("engine", {})
+        self.engine_projects = self.engine_config.get("projects", 4)
+        engine.init_engine(self.engine_config)
 
         with open(config["students_list"]) as f:
             self.students = [l.strip() for l in f]
@@ -37,17 +61,97 @@ class ReviewApp:
     def _get_project(self, student_id):
         return Project(self.project_config, self._project_root(student_id))
 
+    def _fingerprint(self, project):
+        return {
+            "files": project.fingerprint(),
+            "rules": self.rule_config_hash,
+        }
+
+    def _needs_review(self, student_id):
+        if not storage.has_review(student_id, self.tag):
+            return True
+        if not self.incremental:
+            return False
+        fingerprint = self._fingerprint(self._get_project(student_id))
+        return storage.get_fingerprint(student_id, self.tag) != fingerprint
+
+    def _apply_rule(self, student_id, project):
+        # Closing the project tears down state shared by its rules, like work directories
+        with project, profiling.span(student_id, "student"):
+            return self.rule(project)
+
+    async def _apply_rule_async(self, rule, student_id, project):
+        try:
+            with profiling.span(student_id, "student"):
+                return await engine.apply_rule_async(rule, project)
+        finally:
+            await asyncio.to_thread(project.close)
+
+    def _stored_result(self, student_id):
+        """Result graded by batch mode for the project as it is now, if there is one"""
+        result, fingerprint = storage.get_result(student_id, self.tag)
+        if result is None or fingerprint != self._fingerprint(self._get_project(student_id)):
+            return None
+        return Result.from_json(result)
+
     def do_review(self, student_id):
         project = self._get_project(student_id)
+        fingerprint = self._fingerprint(project)
 
-        res = self.rule(project)
+        res = self._stored_result(student_id)
+        if res is None:
+            res = self._apply_rule(student_id, project)
         review = (self.reviewer(project, res) if res.need_review else "")
 
-        storage.add_review(student_id, self.tag, review)
+        storage.add_review(student_id, self.tag, review, fingerprint)
+        # The result stored by batch mode was consumed by the review
+        storage.delete_result(student_id, self.tag)
+
+    def _finish_review(self, student_id, project, res):
+        # The project staged for the review is closed once the review is done
+        with project:
+            review = (self.reviewer(project, res) if res.need_review else "")
+            fingerprint = self._fingerprint(project)
+
+        storage.add_review(student_id, self.tag, review, fingerprint)
+        storage.delete_result(student_id, self.tag)
+        print(f"Review finished for {student_id}")
+
+    def _review_results(self, results):
+        """Reviews (student_id, result) pairs in order. With review_prefetch set, the reviewer
+        prepares the next projects in the background while the current one is being reviewed"""
+        if self.prefetch <= 0:
+            for student_id, res in results:
+                self._finish_review(student_id, self._get_project(student_id), res)
+            return
+
+        staged = Queue(maxsize=self.prefetch)
+        def stage():
+            try:
+                for student_id, res in results:
+                    project = self._get_project(student_id)
+                    if res.need_review:
+                        self.reviewer.prepare(project, res)
+                    staged.put((student_id, project, res))
+                staged.put(None)
+            except Exception as e:
+                staged.put(e)
+
+        stager_thread = Thread(target=stage)
+        stager_thread.daemon = True
+        stager_thread.start()
+
+        while True:
+            item = staged.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            self._finish_review(*item)
 
     def review_all_sync(self):
         for student_id in self.students:
-            if storage.has_review(student_id, self.tag):
+            if not self._needs_review(student_id):
                 continue
             self.do_review(student_id)
             print(f"Finished {student_id}")
@@ -55,25 +159,129 @@ class ReviewApp:
     def _run_rule_loop(self, students, result_queue):
         for student_id in students:
             project = self._get_project(student_id)
-            res = self.rule(project)
+            res = self._apply_rule(student_id, project)
             result_queue.put(res)
 
-    def review_all_async(self):
-        students = list(filter(lambda s: not storage.has_review(s, self.tag), self.students))
-
+    def _results_thread(self, students):
         result_queue = Queue(maxsize=self.run_queue_limit)
         runner_thread = Thread(target=self._run_rule_loop, args=(students, result_queue))
 
         runner_thread.daemon = True
         runner_thread.start()
 
+        return ((student_id, result_queue.get()) for student_id in students)
+
+    def _results_pool(self, students):
+        initargs = (self.rule_config, self.project_config, self.project_root_template, cache.get_cache_config(),
+                    self.file_memory_limit, profiling.is_enabled(), self.engine_config)
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=initargs) as pool:
+            pending = deque()
+            next_student = iter(students)
+
+            def submit_next():
+                student_id = next(next_student, None)
+                if student_id is not None:
+                    pending.append((student_id, pool.submit(_apply_rule_in_worker, student_id)))
+
+            # Same back-pressure as the queue: at most async_queue_limit finished results
+            # waiting for the reviewer on top of the ones being computed right now
+            for _ in range(self.run_queue_limit + self.workers):
+                submit_next()
+
+            while pending:
+                student_id, future = pending.popleft()
+                res, spans = future.result()
+                profiling.add_spans(spans)
+                submit_next()
+                yield student_id, res
+
+    def _results_engine(self, students):
+        # Several projects are graded at once on the engine loop, their subprocesses share
+        # the engine's limit. Rules keep the state of the project they are applied to, like
+        # its work directory, so every project being graded gets rule instances of its own
+        rules = engine.get_engine().call(asyncio.Queue)
+        rules.put_nowait(self.rule)
+        for _ in range(self.engine_projects - 1):
+            rules.put_nowait(construct_rule({"name": "compound", "config": self.rule_config}))
+
+        async def apply_rule(student_id):
+            rule = await rules.get()
+            try:
+                return await self._apply_rule_async(rule, student_id, self._get_project(student_id))
+            finally:
+                rules.put_nowait(rule)
+
+        pending = deque()
+        next_student = iter(students)
+
+        def submit_next():
+            student_id = next(next_student, None)
+            if student_id is not None:
+                pending.append((student_id, engine.get_engine().submit(apply_rule(student_id))))
+
+        for _ in range(self.run_queue_limit + self.engine_projects):
+            submit_next()
+
+        while pending:
+            student_id, future = pending.popleft()
+            res = future.result()
+            submit_next()
+            yield student_id, res
+
+    def _graded_results(self, students):
+        """(student_id, result) pairs in order, for all students, from the rules applied
+        in worker processes, on the engine or in a thread"""
+        if self.workers > 1:
+            return self._results_pool(students)
+        if engine.is_enabled():
+            return self._results_engine(students)
+        return self._results_thread(students)
+
+    def _results(self, students):
+        """Like _graded_results, but with results stored by batch mode loaded instead of
+        being graded again. A stored result is only checked against the project when its
+        turn comes, and the project is graded then if it changed."""
+        stored = {s for s in students if storage.get_result(s, self.tag)[0] is not None}
+        graded = self._graded_results([s for s in students if s not in stored])
         for student_id in students:
-            project = self._get_project(student_id)
-            res = result_queue.get()
-            review = (self.reviewer(project, res) if res.need_review else "")
+            if student_id not in stored:
+                yield next(graded)
+                continue
 
-            storage.add_review(student_id, self.tag, review)
-            print(f"Review finished for {student_id}")
+            res = self._stored_result(student_id)
+            if res is None:
+                res = self._apply_rule(student_id, self._get_project(student_id))
+            yield student_id, res
+
+    def review_all_async(self):
+        students = list(filter(self._needs_review, self.students))
+        self._review_results(self._results(students))
+
+    def _students_to_grade(self):
+        return [s for s in self.students if self._needs_review(s) and self._stored_result(s) is None]
+
+    def _store_result(self, student_id, result):
+        fingerprint = self._fingerprint(self._get_project(student_id))
+        storage.add_result(student_id, self.tag, result, fingerprint)
+
+    def grade_all(self):
+        """Batch mode: grades every student not reviewed yet and stores the results
+        for a later review session, without a reviewer"""
+        for student_id, res in self._graded_results(self._students_to_grade()):
+            self._store_result(student_id, res.to_json())
+            print(f"Graded {student_id}")
+
+    def grade_all_distributed(self, config):
+        """Batch mode with the rules applied by grader worker processes, here or on other hosts"""
+        settings = {
+            "rule_config": self.rule_config,
+            "project_config": self.project_config,
+            "project_root_template": self.project_root_template,
+            "cache": cache.get_cache_config(),
+            "file_memory_limit": self.file_memory_limit,
+            "engine": self.engine_config,
+        }
+        Coordinator(self, settings, config).run(self._students_to_grade())
 
     def review_all(self):
         if self.run_async:
@@ -82,6 +290,44 @@ class ReviewApp:
             self.review_all_sync()
 
 
+_worker_runner = None
+
+
+def _init_worker(rule_config, project_config, project_root_template, cache_config, file_memory_limit, profile,
+                 engine_config):
+    global _worker_runner
+    cache.init_cache(cache_config)
+    set_content_budget(file_memory_limit)
+    profiling.init_profiler(profile)
+    engine.init_engine(engine_config)
+    _worker_runner = _RuleRunner(rule_config, project_config, project_root_template)
+
+
+def _setup_distributed_worker(settings):
+    _init_worker(settings["rule_config"], settings["project_config"], settings["project_root_template"],
+                 settings["cache"], settings["file_memory_limit"], False, settings["engine"])
+    return lambda student_id: _worker_runner._apply_rule(student_id, _worker_runner._get_project(student_id))
+
+
+def _apply_rule_in_worker(student_id):
+    res = _worker_runner._apply_rule(student_id, _worker_runner._get_project(student_id))
+    # Spans recorded in the worker are merged into the profile of the main process
+    return res, profiling.drain()
+
+
+class _RuleRunner:
+    def __init__(self, rule_config, project_config, project_root_template):
+        self.rule = construct_rule({"name": "compound", "config": rule_config})
+        self.project_config = project_config
+        self.project_root_template = project_root_template
+
+    def _get_project(self, student_id):
+        root = local.path(self.project_root_template.replace("STUDENT_ID", student_id))
+        return Project(self.project_config, root)
+
+    _apply_rule = ReviewApp._apply_rule
+
+
 def handle_review(args):
     with open(args.config) as f:
         config = json.load(f)
@@ -92,37 +338,92 @@ def handle_review(args):
     with open(args.project_config) as f:
         project_config = json.load(f)
 
-    review_app = ReviewApp(config, rule_config, project_config)
+    if args.no_cache:
+        config.setdefault("cache", {})["results"] = False
+
+    review_app = ReviewApp(config, rule_config, project_config, incremental=args.incremental, profile=args.profile)
 
     if args.student_id:
         review_app.do_review(args.student_id)
     else:
         review_app.review_all()
 
+    if args.profile:
+        profiling.save(config.get("profile_path", "profile.json"))
+
+
+def handle_batch(args):
+    with open(args.config) as f:
+        config = json.load(f)
+
+    with open(args.rule_config) as f:
+        rule_config = json.load(f)
+
+    with open(args.project_config) as f:
+        project_config = json.load(f)
+
+    if config.get("review_tag") is None:
+        raise ValueError("Batch mode needs a review_tag to store results under")
+
+    # Nobody waits for the results, so use every core unless told otherwise
+    config["workers"] = args.workers or config.get("workers", os.cpu_count())
+    if args.no_cache:
+        config.setdefault("cache", {})["results"] = False
+
+    review_app = ReviewApp(config, rule_config, project_config, incremental=args.incremental, profile=args.profile,
+                           headless=True)
+    if args.distributed:
+        distributed_config = config.get("distributed", {})
+        if args.workers:
+            distributed_config["local_workers"] = args.workers
+        review_app.grade_all_distributed(distributed_config)
+    else:
+        review_app.grade_all()
+
+    if args.profile:
+        profiling.save(config.get("profile_path", "profile.json"))
+
+
+def handle_worker(args):
+    # Workers get the rule and project configs from the coordinator, so that they can run
+    # on hosts without the config files
+    authkey = os.environ.get("GRADER_AUTHKEY")
+    if authkey is None:
+        with open(args.config) as f:
+            authkey = json.load(f)["distributed"]["authkey"]
+
+    run_worker(args.connect, authkey, _setup_distributed_worker)
+
 
 def handle_export(args):
     with open(args.config) as f:
         config = json.load(f)
 
     storage.init_storage(config["storage_path"])
-    reviews = storage.get_reviews()
-    tags = set()
+    tags = storage.get_tags()
     with open(config["students_list"]) as f:
         students = [l.strip() for l in f]
 
-    for student in students:
-        for tag in reviews.get(student, {}):
-            tags.add(tag)
-
-
     with open(args.output, "w") as f:
         for student in students:
+            reviews = storage.get_student_reviews(student)
             values = [student]
             for tag in tags:
-                values.append(reviews.get(student, {}).get(tag, ""))
+                values.append(reviews.get(tag, ""))
             f.write('\t'.join(values) + '\n')
 
 
+def handle_profile(args):
+    with open(args.config) as f:
+        config = json.load(f)
+
+    spans = profiling.load(config.get("profile_path", "profile.json"))
+    print(profiling.report(spans, args.top))
+
+    if args.trace:
+        with open(args.trace, "w") as f:
+            json.dump(profiling.chrome_trace(spans), f)
+
 
 def run():
     parser = argparse.ArgumentParser()
@@ -130,7 +431,10 @@ def run():
 
     handlers = {
         "review": handle_review,
+        "batch": handle_batch,
+        "worker": handle_worker,
         "export": handle_export,
+        "profile": handle_profile,
     }
 
     subparsers = parser.add_subparsers(title="actions", dest="action")
@@ -138,11 +442,30 @@ def run():
 
     review_parser.add_argument("-r", "--rule-config", required=True)
     review_parser.add_argument("-p", "--project-config", required=True)
+    review_parser.add_argument("-i", "--incremental", action="store_true")
+    review_parser.add_argument("--no-cache", action="store_true")
+    review_parser.add_argument("--profile", action="store_true")
     review_parser.add_argument("student_id", nargs='?')
 
+    batch_parser = subparsers.add_parser("batch", add_help=False)
+    batch_parser.add_argument("-r", "--rule-config", required=True)
+    batch_parser.add_argument("-p", "--project-config", required=True)
+    batch_parser.add_argument("-i", "--incremental", action="store_true")
+    batch_parser.add_argument("-j", "--workers", type=int)
+    batch_parser.add_argument("--no-cache", action="store_true")
+    batch_parser.add_argument("--profile", action="store_true")
+    batch_parser.add_argument("--distributed", action="store_true")
+
+    worker_parser = subparsers.add_parser("worker", add_help=False)
+    worker_parser.add_argument("--connect", required=True)
+
     export_parser = subparsers.add_parser("export", add_help=False)
     export_parser.add_argument("-o", "--output", required=True)
 
+    profile_parser = subparsers.add_parser("profile", add_help=False)
+    profile_parser.add_argument("-n", "--top", type=int, default=10)
+    profile_parser.add_argument("-t", "--trace")
+
     args = parser.parse_args()
 
 
@@ -0,0 +1,115 @@
+import shlex
+
+from grader.cache import get_cache, hash_key
+from grader.machine import run_in_workdir
+from grader.util import get_object_file_name, get_object_key
+from grader.workspace import make_tempdir
+
+from threading import Lock
+
+
+class BuildArtifact:
+    def __init__(self, path, command, retcode, out, err):
+        self.path = path
+        self.command = command
+        self.retcode = retcode
+        self.out = out
+        self.err = err
+
+
+class BuildRegistry:
+    """Object files and executables built for a project, keyed by their inputs and flags.
+
+    Artifacts are kept in a directory of their own on the machine, so they outlive the
+    work directory of the rule that built them and can be reused by any later rule.
+    Failed builds are recorded too, together with the compiler output.
+    """
+    def __init__(self, machine_pool):
+        self.machine_pool = machine_pool
+        self.path = None
+        self.artifacts = {}
+        self.lock = Lock()
+
+    def _artifact_dir(self, machine):
+        with self.lock:
+            if self.path is None:
+                self.path = make_tempdir(machine)
+            return self.path
+
+    def get(self, key):
+        with self.lock:
+            return self.artifacts.get(key)
+
+    def add(self, key, machine, built_path, command, retcode, out, err):
+        path = None
+        if not retcode:
+            path = self._artifact_dir(machine) / key
+            run_in_workdir(machine, built_path.dirname, f"cp {shlex.quote(built_path.name)} {shlex.quote(str(path))}", retcode=0)
+        artifact = BuildArtifact(path, command, retcode, out, err)
+        with self.lock:
+            self.artifacts[key] = artifact
+        return artifact
+
+    def close(self):
+        if self.path is None:
+            return
+        with self.machine_pool.lease() as conn:
+            conn.session.run(f"rm -rf {shlex.quote(str(self.path))}")
+        self.path = None
+
+
+def get_build_registry(project, machine_pool):
+    def create():
+        registry = BuildRegistry(machine_pool)
+        project.on_close(registry.close)
+        return registry
+
+    return project.cached(("build_registry", id(machine_pool)), create)
+
+
+def _restore(machine, artifact, path):
+    if artifact.path is not None:
+        run_in_workdir(machine, path.dirname, f"cp {shlex.quote(str(artifact.path))} {shlex.quote(path.name)}", retcode=0)
+
+
+def compile_object(rule, project, source, compiler, cflags):
+    """Compiles source into an object file next to it in the rule's work directory,
+    reusing an object built with the same compiler and flags by any rule before.
+    Returns the object key and the build artifact. Safe to call from several threads."""
+    registry = get_build_registry(project, rule.machine_pool)
+    key = get_object_key(source.path, None if rule.machine_type == "local" else rule.machine, compiler, cflags)
+    obj_name = get_object_file_name(source.name)
+
+    artifact = registry.get(key)
+    if artifact is not None:
+        _restore(rule.machine, artifact, rule.workdir / obj_name)
+        return key, artifact
+
+    cmd = f"{compiler} {cflags} -c -o {obj_name} {source.name}"
+    retcode, out, err = run_in_workdir(rule.machine, rule.workdir, cmd)
+    artifact = registry.add(key, rule.machine, rule.workdir / obj_name, cmd, retcode, out, err)
+
+    # Let symbol extraction reuse the object file if it was built locally with the same flags
+    if not retcode and rule.machine_type == "local":
+        objects = get_cache("objects")
+        if objects.get_path(key) is None:
+            with open(rule.workdir / obj_name, "rb") as f:
+                objects.put(key, f.read())
+
+    return key, artifact
+
+
+def link_executable(rule, project, object_keys, object_names, compiler, ldflags, output="a.out"):
+    """Links object files previously built by compile_object in the rule's work directory,
+    reusing an executable linked from the same objects with the same flags."""
+    registry = get_build_registry(project, rule.machine_pool)
+    key = hash_key(compiler, ldflags, *object_keys)
+
+    artifact = registry.get(key)
+    if artifact is not None:
+        _restore(rule.machine, artifact, rule.workdir / output)
+        return artifact
+
+    cmd = f"{compiler} {ldflags} -o {output} {' '.join(object_names)}"
+    retcode, out, err = run_in_workdir(rule.machine, rule.workdir, cmd)
+    return registry.add(key, rule.machine, rule.workdir / output, cmd, retcode, out, err)
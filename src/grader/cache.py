@@ -0,0 +1,133 @@
+import hashlib
+import os
+import tempfile
+
+from threading import Lock
+
+
+class _Budget:
+    """Size of the entries of all namespaces under the cache root, which share max_size.
+    The least recently used entries of any namespace are evicted first."""
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.size = None
+        self.lock = Lock()
+
+    def _scan(self):
+        entries = []
+        for namespace in os.scandir(self.path):
+            if not namespace.is_dir():
+                continue
+            for entry in os.scandir(namespace.path):
+                if entry.is_file() and not entry.name.startswith("."):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def account(self, size):
+        with self.lock:
+            if self.size is None:
+                self.size = sum(s for _, s, _ in self._scan())
+            else:
+                self.size += size
+            if self.size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(self._scan())
+        self.size = sum(s for _, s, _ in entries)
+        target = self.max_size * 0.9
+        for _, size, path in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+
+class DiskCache:
+    def __init__(self, path, budget):
+        self.path = path
+        self.budget = budget
+        os.makedirs(self.path, exist_ok=True)
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def get_path(self, key):
+        path = self._entry_path(key)
+        try:
+            # mtime is used as the last access time for LRU eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def get(self, key):
+        path = self.get_path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put_file(self, key, src_path):
+        size = os.path.getsize(src_path)
+        path = self._entry_path(key)
+        # Rename is atomic, so other threads and processes never see a partial entry
+        os.replace(src_path, path)
+        self.budget.account(size)
+        return path
+
+    def put(self, key, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix=".")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return self.put_file(key, tmp_path)
+
+
+_config = {
+    "path": ".grader_cache",
+    "max_size_mb": 512,
+    "results": True,
+}
+_caches = {}
+_caches_lock = Lock()
+_budget = None
+
+
+def init_cache(config):
+    global _budget
+    _config.update(config)
+    with _caches_lock:
+        _caches.clear()
+        _budget = None
+
+
+def get_cache_config():
+    return dict(_config)
+
+
+def get_cache(namespace):
+    """Cache of namespace. max_size_mb bounds the size of all namespaces together."""
+    global _budget
+    with _caches_lock:
+        if namespace not in _caches:
+            if _budget is None:
+                _budget = _Budget(_config["path"], _config["max_size_mb"] * 1024 * 1024)
+            _caches[namespace] = DiskCache(os.path.join(_config["path"], namespace), _budget)
+        return _caches[namespace]
+
+
+def hash_key(*parts):
+    h = hashlib.sha256()
+    for p in parts:
+        if isinstance(p, str):
+            p = p.encode()
+        h.update(hashlib.sha256(p).digest())
+    return h.hexdigest()
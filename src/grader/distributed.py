@@ -0,0 +1,253 @@
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import time
+import traceback
+
+from collections import defaultdict, deque
+from multiprocessing.managers import BaseManager
+from queue import Queue, Empty
+from threading import Condition, Thread
+
+from grader.machine import get_remote_machine_pool, get_remote_machine_pool_with_password
+from grader.result import Result
+
+
+class WorkQueue:
+    """Students to grade, shared by the coordinator with all workers.
+
+    Workers take one student at a time, so fast workers simply take more of them. A student
+    is leased to its worker for lease_timeout seconds and the lease is extended by the
+    worker's heartbeats. Students of workers that stop sending them, or that report an
+    error, are handed out again, up to max_attempts times. Once nothing is left to hand out,
+    idle workers steal students that have been graded for more than steal_after seconds and
+    grade them a second time, and whichever result comes first is kept.
+    """
+    def __init__(self, students, settings, lease_timeout=60, max_attempts=3, steal_after=30):
+        self.settings = settings
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.steal_after = steal_after
+
+        self.pending = deque(students)
+        self.total = len(students)
+        self.done = set()
+        # student_id -> {worker_id: lease deadline}
+        self.leases = defaultdict(dict)
+        self.started = {}
+        self.failures = defaultdict(int)
+        self.errors = {}
+        self.last_heartbeat = None
+        self.results = Queue()
+        self.cond = Condition()
+
+    def get_settings(self):
+        return self.settings
+
+    def take(self, worker_id):
+        """The next student for worker_id to grade, or None once all of them are graded"""
+        with self.cond:
+            while True:
+                self._expire_leases()
+                if len(self.done) == self.total:
+                    return None
+
+                student_id = self.pending.popleft() if self.pending else self._straggler(worker_id)
+                if student_id is not None:
+                    self.leases[student_id][worker_id] = time.monotonic() + self.lease_timeout
+                    self.started.setdefault(student_id, time.monotonic())
+                    return student_id
+
+                self.cond.wait(1)
+
+    def heartbeat(self, worker_id):
+        with self.cond:
+            now = time.monotonic()
+            self.last_heartbeat = now
+            for leases in self.leases.values():
+                if worker_id in leases:
+                    leases[worker_id] = now + self.lease_timeout
+
+    def complete(self, worker_id, student_id, result):
+        with self.cond:
+            self.leases.get(student_id, {}).pop(worker_id, None)
+            if student_id in self.done:
+                # The student was stolen and the other worker was faster
+                return
+            self._finish(student_id, result)
+
+    def fail(self, worker_id, student_id, error):
+        with self.cond:
+            if self.leases.get(student_id, {}).pop(worker_id, None) is not None:
+                self._retry(student_id, error)
+
+    def _finish(self, student_id, result):
+        self.done.add(student_id)
+        self.leases.pop(student_id, None)
+        self.results.put((student_id, result))
+        self.cond.notify_all()
+
+    def _retry(self, student_id, error):
+        if student_id in self.done:
+            return
+        self.failures[student_id] += 1
+        self.errors[student_id] = error
+        if self.leases.get(student_id):
+            # Still being graded by the worker that stole it
+            return
+
+        self.started.pop(student_id, None)
+        if self.failures[student_id] < self.max_attempts:
+            self.pending.appendleft(student_id)
+            self.cond.notify_all()
+            return
+
+        res = Result(need_review=True)
+        res.messages.append(f"Grading of {student_id} failed {self.failures[student_id]} times, last error:\n{error}")
+        self._finish(student_id, res.to_json())
+
+    def _expire_leases(self):
+        now = time.monotonic()
+        for student_id, leases in list(self.leases.items()):
+            for worker_id, deadline in list(leases.items()):
+                if deadline < now:
+                    del leases[worker_id]
+                    self._retry(student_id, f"worker {worker_id} stopped responding")
+
+    def _straggler(self, worker_id):
+        now = time.monotonic()
+        candidates = [s for s, leases in self.leases.items()
+                      if len(leases) == 1 and worker_id not in leases and now - self.started[s] >= self.steal_after]
+        return min(candidates, key=self.started.get, default=None)
+
+
+class _WorkManager(BaseManager):
+    pass
+
+
+def _parse_address(address):
+    host, _, port = address.rpartition(":")
+    return host, int(port)
+
+
+class Coordinator:
+    """Serves the students of a batch run to workers, here or on other hosts, and stores
+    the results they send back"""
+    def __init__(self, review_app, settings, config):
+        self.review_app = review_app
+        self.config = config
+        self.settings = settings
+        # Without a configured key only the workers started by the coordinator can connect
+        self.authkey = config.get("authkey", os.environ.get("GRADER_AUTHKEY")) or secrets.token_hex(16)
+        self.local_workers = config.get("local_workers", 0)
+        self.remote_workers = config.get("remote_workers", [])
+        self.processes = []
+
+    def _start_server(self, queue):
+        _WorkManager.register("work_queue", callable=lambda: queue)
+        manager = _WorkManager(address=_parse_address(self.config.get("listen", "127.0.0.1:0")),
+                               authkey=self.authkey.encode())
+        server = manager.get_server()
+        server_thread = Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        host, port = server.address
+        if host in ("", "0.0.0.0"):
+            host = socket.getfqdn()
+        return f"{self.config.get('advertise', host)}:{port}"
+
+    def _worker_args(self, address):
+        return ["-m", "grader", "-c", os.devnull, "worker", "--connect", address]
+
+    def _start_workers(self, address):
+        env = {**os.environ, "GRADER_AUTHKEY": self.authkey}
+        for _ in range(self.local_workers):
+            self.processes.append(subprocess.Popen([sys.executable, *self._worker_args(address)], env=env))
+
+        for worker in self.remote_workers:
+            if "keyfile" in worker:
+                pool = get_remote_machine_pool(worker["host"], worker["user"], worker["keyfile"])
+            else:
+                pool = get_remote_machine_pool_with_password(worker["host"], worker["user"])
+            with pool.lease() as conn, conn.machine.env(GRADER_AUTHKEY=self.authkey):
+                command = conn.machine[worker.get("python", "python3")][self._worker_args(address)]
+                for _ in range(worker.get("count", 1)):
+                    self.processes.append(command.popen())
+
+    def _workers_gone(self, queue):
+        # Workers started by hand may still connect, so only give up on our own ones
+        if not self.processes or any(p.poll() is None for p in self.processes):
+            return False
+        with queue.cond:
+            return queue.last_heartbeat is None or time.monotonic() - queue.last_heartbeat > queue.lease_timeout
+
+    def run(self, students):
+        lease_timeout = self.config.get("lease_timeout", 60)
+        queue = WorkQueue(students, {**self.settings, "lease_timeout": lease_timeout}, lease_timeout,
+                          self.config.get("max_attempts", 3), self.config.get("steal_after", 30))
+        address = self._start_server(queue)
+        print(f"Serving {len(students)} students at {address}")
+        self._start_workers(address)
+
+        try:
+            for _ in range(len(students)):
+                while True:
+                    try:
+                        student_id, result = queue.results.get(timeout=1)
+                        break
+                    except Empty:
+                        if self._workers_gone(queue):
+                            raise RuntimeError("All workers exited before grading finished")
+                self.review_app._store_result(student_id, result)
+                print(f"Graded {student_id}")
+        finally:
+            # Workers exit on their own once there is nothing left, remote ones end with
+            # their SSH channel
+            for p in self.processes:
+                if isinstance(p, subprocess.Popen):
+                    try:
+                        p.wait(timeout=queue.lease_timeout)
+                    except subprocess.TimeoutExpired:
+                        p.kill()
+
+
+def run_worker(address, authkey, setup):
+    """Grades students taken from the coordinator at address until there are none left.
+    setup is called with the coordinator's settings and returns the function grading a
+    student."""
+    _WorkManager.register("work_queue")
+    manager = _WorkManager(address=_parse_address(address), authkey=authkey.encode())
+    manager.connect()
+    queue = manager.work_queue()
+    settings = queue.get_settings()
+    grade = setup(settings)
+
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    def send_heartbeats():
+        # Proxies open a connection per thread, so this doesn't wait for grading calls
+        while True:
+            try:
+                queue.heartbeat(worker_id)
+            except (OSError, EOFError):
+                # The coordinator is gone, the main loop finds out on its next call
+                return
+            time.sleep(settings["lease_timeout"] / 3)
+
+    heartbeat_thread = Thread(target=send_heartbeats)
+    heartbeat_thread.daemon = True
+    heartbeat_thread.start()
+
+    while True:
+        student_id = queue.take(worker_id)
+        if student_id is None:
+            break
+        try:
+            res = grade(student_id)
+        except Exception:
+            queue.fail(worker_id, student_id, traceback.format_exc())
+            continue
+        queue.complete(worker_id, student_id, res.to_json())
+        print(f"Graded {student_id}")
@@ -0,0 +1,166 @@
+import asyncio
+import contextvars
+import os
+import threading
+
+from concurrent.futures import Future
+
+from plumbum.commands.processes import ProcessExecutionError
+
+
+class Engine:
+    """Event loop running in a thread of its own, on which subprocesses are started with
+    asyncio instead of one blocked thread per subprocess. The number of subprocesses
+    running at once is limited by a semaphore shared by all rules and students.
+    """
+    def __init__(self, max_subprocesses):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.subprocesses = self.call(asyncio.Semaphore, max_subprocesses)
+
+    def call(self, func, *args):
+        """Calls func on the engine loop and returns its result. asyncio primitives, like
+        semaphores and queues, are created this way, as before Python 3.10 they belong to
+        the event loop of the thread creating them."""
+        async def call():
+            return func(*args)
+        return asyncio.run_coroutine_threadsafe(call(), self.loop).result()
+
+    def submit(self, coro):
+        """Schedules coro on the engine loop and returns a concurrent.futures.Future for it.
+        The coroutine runs in a copy of the caller's context, so e.g. profiling spans open
+        in the calling thread are its parents."""
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        def done(task):
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        def start():
+            # Tasks run in the context current when they are created, which is the one
+            # call_soon_threadsafe runs this callback in
+            self.loop.create_task(coro).add_done_callback(done)
+
+        self.loop.call_soon_threadsafe(start, context=contextvars.copy_context())
+        return future
+
+    def run(self, coro):
+        """Runs coro on the engine loop and waits for its result, from any other thread"""
+        if threading.current_thread() is self.thread:
+            raise RuntimeError("can't wait for the engine on its own loop, await instead")
+        return self.submit(coro).result()
+
+    def close(self):
+        """Stops the loop and its thread. Tasks still running on it are dropped."""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+_config = {
+    "enabled": False,
+    "max_subprocesses": 32,
+}
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def init_engine(config):
+    global _engine
+    with _engine_lock:
+        _config.update(config)
+        engine, _engine = _engine, None
+    # The next get_engine starts a new loop with the new config
+    if engine is not None:
+        engine.close()
+
+
+def is_enabled():
+    return _config["enabled"]
+
+
+def get_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = Engine(_config["max_subprocesses"])
+        return _engine
+
+
+async def run_subprocess(argv, cwd=None, stdin=None):
+    """Runs argv, with stdin taken from a file object if given, and returns the exit status,
+    stdout and stderr like plumbum's run does"""
+    async with get_engine().subprocesses:
+        proc = await asyncio.create_subprocess_exec(
+            *argv, cwd=cwd, stdin=stdin if stdin is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        out, err = await proc.communicate()
+    return proc.returncode, out.decode(errors="replace"), err.decode(errors="replace")
+
+
+def run_local(argv, cwd=None, retcode=0):
+    """Blocking call of run_subprocess from a rule, raising like plumbum if the exit status
+    is not retcode"""
+    status, out, err = get_engine().run(run_subprocess(argv, cwd))
+    if retcode is not None and status != retcode:
+        raise ProcessExecutionError(argv, status, out, err)
+    return status, out, err
+
+
+class StreamingProcess:
+    """Subprocess with stdout read chunk by chunk. Closing the output stops a program run
+    in the sandbox, which watches the reader of its output."""
+    def __init__(self, proc, transport, reader):
+        self.proc = proc
+        self.transport = transport
+        self.reader = reader
+
+    async def read(self, size):
+        return await self.reader.read(size)
+
+    def close_output(self):
+        self.transport.close()
+
+    def terminate(self):
+        try:
+            self.proc.terminate()
+        except ProcessLookupError:
+            pass
+
+    async def wait(self):
+        return await self.proc.wait()
+
+
+async def start_streaming(argv, cwd=None, stdin=None):
+    """Starts argv with stdout connected to a pipe of our own, so that the read end can be
+    closed early. Must run while holding a slot of the engine's subprocess semaphore."""
+    read_fd, write_fd = os.pipe()
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *argv, cwd=cwd, stdin=stdin if stdin is not None else asyncio.subprocess.DEVNULL,
+            stdout=write_fd, stderr=asyncio.subprocess.DEVNULL)
+    except Exception:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+
+    reader = asyncio.StreamReader()
+    transport, _ = await asyncio.get_running_loop().connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(read_fd, "rb", 0))
+    return StreamingProcess(proc, transport, reader)
+
+
+async def apply_rule_async(rule, project):
+    """Applies any rule on the engine loop. Rules with an async apply_async are awaited,
+    all others run unchanged in a worker thread."""
+    if hasattr(rule, "apply_async"):
+        return await rule.apply_async(project)
+    return await asyncio.to_thread(rule, project)
@@ -0,0 +1,121 @@
+import re
+import sys
+
+from collections import namedtuple
+
+
+Token = namedtuple("Token", ["kind", "text", "line", "col"])
+Comment = namedtuple("Comment", ["text", "start_line", "end_line", "block"])
+
+
+_TOKEN_RE = re.compile(r"""
+    (?P<block_comment>/\*.*?(?:\*/|\Z))
+  | (?P<line_comment>//[^\n]*)
+  | (?P<string>"(?:\\.|[^"\\\n])*"?)
+  | (?P<char>'(?:\\.|[^'\\\n])*'?)
+  | (?P<number>0[xX](?:[pP][+-]|[0-9a-zA-Z_.])*|\.?[0-9](?:[eEpP][+-]|[0-9a-zA-Z_.])*)
+  | (?P<ident>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<newline>\n)
+  | (?P<space>[ \t\r\f\v]+)
+  | (?P<punct>.)
+""", re.VERBOSE | re.DOTALL)
+
+
+class LexicalModel:
+    """Result of a single tokenizer pass over a C file.
+
+    Lines are numbered from 0. Token columns refer to the line with comments removed
+    (see code_lines), which is what the style rules look at. depth holds the curly
+    brace nesting level at the start of every line, not counting braces in comments,
+    strings and character literals.
+    """
+    def __init__(self, text):
+        self.text = text
+        self.tokens = []
+        self.comments = []
+        self.line_offsets = [0]
+        self.depth = [0]
+        self.directives = set()
+        self.tab_count = text.count("\t")
+        self.cr_count = text.count("\r")
+        self._memory_size = None
+
+        code_lines = []
+        code = []
+        col = 0
+        depth = 0
+        line_start = True
+
+        def new_line(offset):
+            nonlocal code, col, line_start
+            code_lines.append("".join(code))
+            code = []
+            col = 0
+            line_start = True
+            self.line_offsets.append(offset)
+            self.depth.append(depth)
+
+        for m in _TOKEN_RE.finditer(text):
+            kind = m.lastgroup
+            value = m.group()
+            line = len(self.line_offsets) - 1
+
+            if kind == "newline":
+                new_line(m.end())
+            elif kind == "space":
+                code.append(value)
+                col += len(value)
+            elif kind in ("block_comment", "line_comment"):
+                end_line = line + value.count("\n")
+                self.comments.append(Comment(value, line, end_line, kind == "block_comment"))
+            else:
+                if line_start and value == "#":
+                    self.directives.add(line)
+                line_start = False
+
+                if value == "{":
+                    depth += 1
+                elif value == "}":
+                    depth -= 1
+
+                self.tokens.append(Token(kind, value, line, col))
+                code.append(value.replace("\n", " "))
+                col += len(value)
+
+            # Block comments and strings continued with a backslash span several lines
+            offset = m.start()
+            for _ in range(value.count("\n") if kind != "newline" else 0):
+                offset = text.index("\n", offset) + 1
+                new_line(offset)
+
+        code_lines.append("".join(code))
+        self.code_lines = code_lines
+
+    def memory_size(self):
+        """Rough number of bytes taken by the model, not counting text, which belongs to the file"""
+        if self._memory_size is not None:
+            return self._memory_size
+        size = sum(sys.getsizeof(t) + sys.getsizeof(t.text) for t in self.tokens)
+        size += sum(sys.getsizeof(c) + sys.getsizeof(c.text) for c in self.comments)
+        size += sum(sys.getsizeof(line) for line in self.code_lines)
+        for seq in (self.tokens, self.comments, self.code_lines, self.line_offsets, self.depth, self.directives):
+            size += sys.getsizeof(seq)
+        # Line offsets and directive line numbers above 256 are int objects of their own
+        self._memory_size = size + 28 * (len(self.line_offsets) + len(self.directives))
+        return self._memory_size
+
+    def line(self, n):
+        """Raw text of line n without the line break"""
+        start = self.line_offsets[n]
+        end = self.line_offsets[n + 1] - 1 if n + 1 < len(self.line_offsets) else len(self.text)
+        return self.text[start:end]
+
+    def line_count(self):
+        return len(self.line_offsets)
+
+    def line_tokens(self):
+        """Tokens grouped by line, with an empty list for lines without code"""
+        lines = [[] for _ in self.line_offsets]
+        for t in self.tokens:
+            lines[t.line].append(t)
+        return lines
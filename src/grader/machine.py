@@ -1,33 +1,216 @@
 import getpass
+import shlex
+import tarfile
+import tempfile
+
 from plumbum import local
 from plumbum.machines.paramiko_machine import ParamikoMachine
 from plumbum.path.utils import copy
 
-def _once(f):
-    res = None
-    def wrapped(*args, **kwargs):
-        nonlocal res
-        if res is None:
-            res = f(*args, **kwargs)
-        return res
-    return wrapped
+from grader.project import Project
+from grader.sandbox import SandboxLimits
+
+import grader.engine as engine
+import grader.profiling as profiling
+from grader.workspace import Workspace, WorkspaceMode, get_workspace
+
+from contextlib import contextmanager
+from queue import Queue, Empty
+from threading import Lock
+
+
+class ProfiledSession:
+    """Shell session recording every command run in it with profiling.command_span"""
+    def __init__(self, session):
+        self.session = session
+
+    def run(self, cmd, retcode=0):
+        with profiling.command_span(str(cmd)):
+            return self.session.run(cmd, retcode)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+# Unsets every environment variable, the ones the session started with are exported again.
+# PATH may have been changed, so the tools are looked up in the default one.
+_RESET_ENV = "for v in $(command -p env | command -p sed -n 's/^\\([A-Za-z_][A-Za-z0-9_]*\\)=.*/\\1/p'); do unset \"$v\" 2>/dev/null; done"
+
+
+class MachineConnection:
+    def __init__(self, machine):
+        self.machine = machine
+        self.session = None
+        self.initial_env = None
+
+    def prepare_session(self):
+        """Opens the shell session on first use, or when the previous one broke. A session
+        kept from the previous lease is reset to the home directory and the environment
+        it started with, so that what the previous user of the connection left behind
+        doesn't leak to the next one."""
+        if self.session is not None and self.session.alive():
+            self.session.run(f"{_RESET_ENV}\n{self.initial_env}\ncd")
+            return
+
+        self.close_session()
+        session = self.machine.session()
+        _, self.initial_env, _ = session.run("export -p")
+        self.session = ProfiledSession(session)
+
+    def close_session(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+
+class MachinePool:
+    """A bounded set of persistent connections to one machine.
+
+    Connections are opened on demand up to size and handed out one at a time, so they
+    are shared by all rules and students instead of being set up per rule invocation.
+    Every connection keeps one shell session, which is reset between leases and only
+    opened again if a lease failed, as the session may be left in any state then.
+    """
+    def __init__(self, connect, size=None):
+        self.connect = connect
+        self.size = size
+        self.idle = Queue()
+        self.created = 0
+        self.lock = Lock()
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            pass
+
+        with self.lock:
+            can_create = self.size is None or self.created < self.size
+            if can_create:
+                self.created += 1
+
+        if can_create:
+            try:
+                return MachineConnection(self.connect())
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+        return self.idle.get()
+
+    @contextmanager
+    def lease(self):
+        conn = self._acquire()
+        try:
+            conn.prepare_session()
+            yield conn
+        except BaseException:
+            conn.close_session()
+            raise
+        finally:
+            self.idle.put(conn)
+
+
+_pools = {}
+_pools_lock = Lock()
+_passwords = {}
+_passwords_lock = Lock()
+
+
+def _get_pool(key, connect, size):
+    # Rules configured with a different number of connections to the same machine get
+    # pools of their own, instead of the size configured first applying to all of them
+    key = (*key, size)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = MachinePool(connect, size)
+        return _pools[key]
 
-@_once
-def get_remote_machine_with_password(host, user):
-    password = getpass.getpass(prompt=f"Password for {user}@{host}: ", stream=None)
 
-    rem = ParamikoMachine(host, user=user, password=password)
-    return rem
+def get_remote_machine_pool_with_password(host, user, size=1):
+    def connect():
+        # Connections opened at the same time must not ask for the password twice
+        with _passwords_lock:
+            if (host, user) not in _passwords:
+                _passwords[(host, user)] = getpass.getpass(prompt=f"Password for {user}@{host}: ", stream=None)
+            password = _passwords[(host, user)]
+        return ParamikoMachine(host, user=user, password=password)
+    return _get_pool(("remote", host, user), connect, size)
 
 
-@_once
-def get_remote_machine(host, user, keyfile):
-    rem = ParamikoMachine(host, user=user, keyfile=keyfile)
-    return rem
+def get_remote_machine_pool(host, user, keyfile, size=1):
+    def connect():
+        return ParamikoMachine(host, user=user, keyfile=keyfile)
+    return _get_pool(("remote", host, user, keyfile), connect, size)
 
 
-def get_local_machine():
-    return local
+def get_local_machine_pool():
+    return _get_pool(("local",), lambda: local, None)
+
+
+def _in_workdir(machine, workdir, cmd):
+    return machine["sh"]["-c", f"cd {shlex.quote(str(workdir))} && {cmd}"]
+
+
+def run_in_workdir(machine, workdir, cmd, retcode=None):
+    """Runs a shell command in workdir on its own instead of in a rule's session,
+    so that several commands can run at once"""
+    with profiling.command_span(cmd):
+        if machine is local and engine.is_enabled():
+            return engine.run_local(["sh", "-c", cmd], str(workdir), retcode)
+        return _in_workdir(machine, workdir, cmd).run(retcode=retcode)
+
+
+def popen_in_workdir(machine, workdir, cmd):
+    """Like run_in_workdir, but returns the process to let the caller stream its output.
+    It is only counted, as it outlives this call."""
+    profiling.count("subprocesses")
+    return _in_workdir(machine, workdir, cmd).popen()
+
+
+def _copy_files(files, project_path):
+    for name, path in files:
+        copy(path, project_path / name)
+
+
+def _upload_files(machine, session, files, project_path, shared_files, blob_cache):
+    """Ships files to a remote machine as a single tar archive instead of one SFTP transfer
+    per file. Shared files are kept in a blob cache on the remote host by content hash,
+    so that e.g. expected outputs identical for all students are only sent once.
+    """
+    archive_remote_path = project_path.dirname / "upload.tar"
+    cached_blobs = set()
+    if blob_cache is not None:
+        blob_cache_path = machine.env.home / blob_cache
+        blob_cache_path.mkdir()
+        cached_blobs = {p.name for p in blob_cache_path.list()}
+
+    commands = [
+        f"cd {shlex.quote(str(project_path))}",
+        f"tar -xf {shlex.quote(str(archive_remote_path))}",
+        f"rm {shlex.quote(str(archive_remote_path))}",
+    ]
+    with tempfile.TemporaryDirectory() as local_dir:
+        archive_path = local.path(local_dir) / "upload.tar"
+        with tarfile.open(archive_path, "w") as archive:
+            for name, path in files:
+                if blob_cache is None or name not in shared_files:
+                    archive.add(path, arcname=name)
+                    continue
+
+                digest = shared_files[name]
+                blob_path = shlex.quote(str(blob_cache_path / digest))
+                if digest in cached_blobs:
+                    commands.append(f"cp {blob_path} {shlex.quote(name)}")
+                else:
+                    archive.add(path, arcname=name)
+                    # Publish the blob with a rename, so other graders never see it half-written
+                    commands.append(f"cp {shlex.quote(name)} {blob_path}.$$ && mv -f {blob_path}.$$ {blob_path}")
+                    cached_blobs.add(digest)
+
+        machine.upload(archive_path, archive_remote_path)
+
+    session.run(" && ".join(commands))
 
 
 def with_machine_rule(cls):
@@ -39,41 +222,76 @@ def with_machine_rule(cls):
             machine_type = config["machine"]["type"]
 
         if machine_type == "local":
-            self.machine = get_local_machine()
+            self.machine_pool = get_local_machine_pool()
             self.files_to_copy = None
+            self.bulk_upload = False
         elif machine_type == "remote":
-            if "keyfile" in config["machine"]:
-                self.machine = get_remote_machine(config["machine"]["host"], config["machine"]["user"], config["machine"]["keyfile"])
+            machine_config = config["machine"]
+            size = machine_config.get("connections", 1)
+            if "keyfile" in machine_config:
+                self.machine_pool = get_remote_machine_pool(machine_config["host"], machine_config["user"], machine_config["keyfile"], size)
             else:
-                self.machine = get_remote_machine_with_password(config["machine"]["host"], config["machine"]["user"])
+                self.machine_pool = get_remote_machine_pool_with_password(machine_config["host"], machine_config["user"], size)
 
-            self.files_to_copy = config["machine"].get("files_to_copy")
+            self.files_to_copy = machine_config.get("files_to_copy")
+            self.bulk_upload = machine_config.get("bulk_upload", True)
+            self.blob_cache = machine_config.get("blob_cache", ".cache/grader/blobs")
         else:
             raise ValueError(f"Invalid machine type: {config['machine']['type']}")
         self.machine_type = machine_type
+        # Rules that don't modify their work directory default to sharing the project copy
+        self.workspace_mode = WorkspaceMode[config.get("workspace", getattr(cls, "default_workspace", "snapshot")).upper()]
+        self.sandbox = SandboxLimits(config.get("sandbox", {}))
+        # Connections are only opened when the rule is applied
+        self.machine = None
+        self.apply_lock = Lock()
         old_init(self, config)
     cls.__init__ = new_init
 
-    old_apply = cls.apply
-    def new_apply(self, project):
-        with self.machine.tempdir() as tempdir:
-            project_path = tempdir / "project"
-            project_path.mkdir()
-            existing_files = set([f.name for f in project.root.list()])
-            if self.files_to_copy:
-                for fname in self.files_to_copy:
-                    if fname in existing_files:
-                        copy(project.root / fname, project_path / fname)
-            else:
-                for f in project.files():
-                    if f.name in existing_files:
-                        copy(f.path, project_path / f.name)
+    def copy_project_files(self, target, conn, project_path):
+        existing_files = set([f.name for f in target.root.list()])
+        if self.files_to_copy:
+            files = [(fname, target.root / fname) for fname in self.files_to_copy if fname in existing_files]
+        else:
+            files = [(f.name, f.path) for f in target.files() if f.name in existing_files]
+
+        if self.bulk_upload:
+            resources = getattr(target, "resources", [])
+            shared_files = {f.name: f.hash() for r in resources for f in r.files() if f.name in existing_files}
+            _upload_files(conn.machine, conn.session, files, project_path, shared_files, self.blob_cache)
+        else:
+            _copy_files(files, project_path)
+
+    @contextmanager
+    def target_workspace(self, target, args):
+        # Under per_module the rule is applied to a module, followed by the project if
+        # the rule asked for it. Without the project the copy can't be shared.
+        project = target if isinstance(target, Project) else next((a for a in args if isinstance(a, Project)), None)
+        copy_files = lambda conn, path: copy_project_files(self, target, conn, path)
+        if project is not None:
+            yield get_workspace(project, target, self.machine_pool, self.files_to_copy, copy_files)
+            return
+
+        workspace = Workspace(self.machine_pool, copy_files)
+        try:
+            yield workspace
+        finally:
+            workspace.close()
 
-            with self.machine.cwd(project_path):
-                self.session = self.machine.session()
+    old_apply = cls.apply
+    def new_apply(self, target, *args):
+        # machine, workdir and session belong to the apply in progress, so applies of the
+        # same rule instance, e.g. to several projects at once, wait for each other. Rules
+        # meant to run side by side need instances of their own.
+        with self.apply_lock, target_workspace(self, target, args) as workspace, self.machine_pool.lease() as conn:
+            self.machine = conn.machine
+            with workspace.checkout(conn, self.workspace_mode) as project_path:
+                # The session is cd'ed into the project instead of changing the cwd of the
+                # whole grader, so that several machine rules can run concurrently
+                self.workdir = project_path
+                self.session = conn.session
                 self.session.run(f"cd {project_path}")
-                return old_apply(self, project)
+                return old_apply(self, target, *args)
     cls.apply = new_apply
-        
-    return cls
 
+    return cls
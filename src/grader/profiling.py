@@ -0,0 +1,186 @@
+import contextvars
+import json
+import os
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Span:
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.counters = defaultdict(int)
+        self.start = time.time()
+        self.cpu_start = time.thread_time()
+        self.wall = None
+        self.cpu = None
+
+    def finish(self):
+        self.wall = time.time() - self.start
+        # Only the CPU time of the thread the span ran on, work handed to other
+        # threads and subprocesses is not included
+        self.cpu = time.thread_time() - self.cpu_start
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "category": self.category,
+            "args": self.args,
+            "start": self.start,
+            "wall": self.wall,
+            "cpu": self.cpu,
+            "counters": dict(self.counters),
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+        }
+
+
+class Profiler:
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def record(self, span):
+        with self.lock:
+            self.spans.append(span.to_dict())
+
+    def add(self, spans):
+        with self.lock:
+            self.spans += spans
+
+    def drain(self):
+        with self.lock:
+            spans, self.spans = self.spans, []
+        return spans
+
+
+_profiler = None
+_counters_lock = threading.Lock()
+# Spans open in the current context, innermost last
+_stack = contextvars.ContextVar("profiling_stack", default=())
+
+
+def init_profiler(enabled):
+    global _profiler
+    _profiler = Profiler() if enabled else None
+
+
+def is_enabled():
+    return _profiler is not None
+
+
+@contextmanager
+def span(name, category, **args):
+    if _profiler is None:
+        yield None
+        return
+
+    s = Span(name, category, args)
+    token = _stack.set(_stack.get() + (s,))
+    try:
+        yield s
+    finally:
+        _stack.reset(token)
+        s.finish()
+        _profiler.record(s)
+
+
+@contextmanager
+def command_span(command):
+    """Span of a command run in a subprocess or a shell session, which also counts as a
+    subprocess of all spans open around it"""
+    count("subprocesses")
+    name = command if len(command) <= 80 else command[:77] + "..."
+    with span(name, "subprocess", command=command) as s:
+        yield s
+
+
+def count(counter, n=1):
+    """Adds n to counter of all open spans, e.g. one subprocess or bytes read"""
+    if _profiler is None:
+        return
+    with _counters_lock:
+        for s in _stack.get():
+            s.counters[counter] += n
+
+
+def propagate(func):
+    """Wraps func to run within the spans open right now, for work handed to a thread pool"""
+    if _profiler is None:
+        return func
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+
+def drain():
+    return _profiler.drain() if _profiler is not None else []
+
+
+def add_spans(spans):
+    if _profiler is not None:
+        _profiler.add(spans)
+
+
+def save(path):
+    with open(path, "w") as f:
+        json.dump(drain(), f)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def chrome_trace(spans):
+    """The spans in the Trace Event Format read by chrome://tracing and Perfetto"""
+    events = []
+    for s in spans:
+        events.append({
+            "name": s["name"],
+            "cat": s["category"],
+            "ph": "X",
+            "ts": s["start"] * 1e6,
+            "dur": s["wall"] * 1e6,
+            "pid": s["pid"],
+            "tid": s["tid"],
+            "args": {**s["args"], **s["counters"], "cpu": s["cpu"]},
+        })
+    return {"traceEvents": events}
+
+
+def _totals(spans, key):
+    totals = defaultdict(lambda: defaultdict(float))
+    for s in spans:
+        t = totals[key(s)]
+        t["count"] += 1
+        t["wall"] += s["wall"]
+        t["cpu"] += s["cpu"]
+        t["max"] = max(t["max"], s["wall"])
+        for name, value in s["counters"].items():
+            t[name] += value
+    return totals
+
+
+def _table(title, totals, top):
+    lines = [title, f"{'name':<40} {'count':>6} {'wall':>9} {'max':>9} {'cpu':>9} {'procs':>6} {'read':>10}"]
+    for name, t in sorted(totals.items(), key=lambda i: -i[1]["wall"])[:top]:
+        lines.append(f"{name[:40]:<40} {int(t['count']):>6} {t['wall']:>8.3f}s {t['max']:>8.3f}s {t['cpu']:>8.3f}s "
+                     f"{int(t['subprocesses']):>6} {int(t['bytes_read']):>10}")
+    return "\n".join(lines)
+
+
+def report(spans, top=10):
+    """Slowest rules, objects and students by total wall time"""
+    by_category = defaultdict(list)
+    for s in spans:
+        by_category[s["category"]].append(s)
+
+    return "\n\n".join([
+        _table("Rules", _totals(by_category["rule"], lambda s: s["name"]), top),
+        _table("Objects", _totals(by_category["object"], lambda s: s["name"]), top),
+        _table("Students", _totals(by_category["student"], lambda s: s["name"]), top),
+    ])
@@ -1,6 +1,19 @@
 from plumbum.path.base import Path
 
+from grader.lexer import LexicalModel
+
+import grader.profiling as profiling
+
+from collections import OrderedDict
 from enum import Enum
+from threading import Lock, RLock
+
+import hashlib
+import mmap
+import os
+import re
+import sys
+import weakref
 
 class FileType(Enum):
     SOURCE = 0
@@ -10,25 +23,158 @@ class FileType(Enum):
     README = 4
     EXTRA = 5
 
+class _ContentBudget:
+    """Bounds the memory taken by file contents, memory maps, line offsets and lexical
+    models kept by File objects.
+
+    Files are tracked from least to most recently used, and the least recently used ones
+    drop all of it when the budget is exceeded. They are read again on next use.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.entries = OrderedDict()
+        # Reentrant, as weakref callbacks may run on the same thread while the lock is held
+        self.lock = RLock()
+
+    def touch(self, f, size):
+        """Marks f as most recently used, taking size bytes in total"""
+        key = id(f)
+        with self.lock:
+            if key in self.entries:
+                ref, old_size = self.entries.pop(key)
+                self.size -= old_size
+            else:
+                ref = weakref.ref(f, lambda _: self._forget(key))
+
+            self.entries[key] = (ref, size)
+            self.size += size
+            while self.size > self.limit and len(self.entries) > 1:
+                ref, _ = self.entries[next(iter(self.entries))]
+                evicted = ref()
+                if evicted is not None and evicted is not f:
+                    evicted._drop_contents()
+                else:
+                    self._forget(next(iter(self.entries)))
+
+    def _forget(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+
+_budget = _ContentBudget(256 * 1024 * 1024)
+
+
+def set_content_budget(limit):
+    global _budget
+    _budget = _ContentBudget(limit)
+
+
 class File:
     def __init__(self, filename: str, type: FileType, root: Path):
         self.type = type
         self.path = root / filename
         self.name = self.path.name
         self.contents = None
-        self.lines = None
+        self.offsets = None
+        self.model = None
+        self.map = None
+
+    def _drop_contents(self):
+        _budget._forget(id(self))
+        self.contents = None
+        self.offsets = None
+        self.model = None
+        mapped, self.map = self.map, None
+        if mapped is not None:
+            try:
+                mapped.close()
+            except BufferError:
+                # A view of it is still in use, the map is closed once that is released
+                pass
+
+    def _memory_size(self):
+        # Read once, as other threads may drop any of them at the same time
+        contents, offsets, model, mapped = self.contents, self.offsets, self.model, self.map
+        size = sys.getsizeof(contents) if contents is not None else 0
+        if offsets is not None:
+            size += sys.getsizeof(offsets) + 28 * len(offsets)
+        if model is not None:
+            size += model.memory_size()
+        if mapped is not None and not mapped.closed:
+            size += len(mapped)
+        return size
+
+    def close(self):
+        """Drops the contents and closes the memory map"""
+        self._drop_contents()
 
     def read(self):
-        if not self.contents:
+        contents = self.contents
+        if contents is None:
             with open(self.path) as f:
-                self.contents = f.read()
-        return self.contents
+                contents = self.contents = f.read()
+            profiling.count("bytes_read", len(contents))
+        _budget.touch(self, self._memory_size())
+        return contents
+
+    def view(self):
+        """Zero-copy read-only view of the raw file bytes, backed by a memory map,
+        so large files are paged in by the OS instead of being copied into memory"""
+        mapped = self.map
+        if mapped is not None:
+            try:
+                view = memoryview(mapped)
+                _budget.touch(self, self._memory_size())
+                return view
+            except ValueError:
+                # Closed by another thread that dropped the contents
+                pass
+
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Empty files can't be mapped
+                return memoryview(b"")
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # The view is taken before the map is shared, so it can't be closed under it
+        view = memoryview(mapped)
+        self.map = mapped
+        profiling.count("bytes_read", len(mapped))
+        _budget.touch(self, self._memory_size())
+        return view
+
+    def line_offsets(self):
+        """Offsets in read() at which every line starts"""
+        contents = self.read()
+        offsets = self.offsets
+        if offsets is None:
+            offsets = self.offsets = [0] + [m.end() for m in re.finditer("\n", contents)]
+            _budget.touch(self, self._memory_size())
+        return offsets
 
     def readlines(self):
-        if not self.lines:
-            with open(self.path) as f:
-                self.lines = f.readlines()
-        return self.lines
+        # Lines are sliced from the contents on demand instead of being kept as a second copy
+        contents = self.read()
+        offsets = self.line_offsets()
+        ends = offsets[1:] + ([len(contents)] if offsets[-1] < len(contents) else [])
+        return [contents[start:end] for start, end in zip(offsets, ends)]
+
+    def lexical_model(self):
+        """Tokens, comments and line structure of the file, computed once and shared by
+        all rules that scan the code"""
+        contents = self.read()
+        model = self.model
+        if model is None:
+            model = self.model = LexicalModel(contents)
+            _budget.touch(self, self._memory_size())
+        return model
+
+    def hash(self):
+        if not self.path.exists():
+            return None
+        return hashlib.sha256(self.view()).hexdigest()
 
     def __str__(self):
         return f"<File {self.path}>"
@@ -116,6 +262,13 @@ def unique(gen_func):
     return wrapper
 
 
+class _CachedValue:
+    def __init__(self):
+        self.lock = Lock()
+        self.ready = False
+        self.value = None
+
+
 class Project:
     def __init__(self, config: dict, root: Path):
         self._modules = [] 
@@ -132,6 +285,43 @@ class Project:
         for filename in config.get("misc", []):
             self.misc.append(File(filename, FileType.EXTRA, root))
 
+        self._cache = {}
+        self._cache_lock = Lock()
+        self._cleanups = []
+
+    def cached(self, key, factory):
+        """Returns the value computed by factory for key once per project, so that state
+        like work directories can be shared by all rules applied to the project"""
+        with self._cache_lock:
+            if key not in self._cache:
+                self._cache[key] = _CachedValue()
+            entry = self._cache[key]
+
+        with entry.lock:
+            if not entry.ready:
+                entry.value = factory()
+                entry.ready = True
+            return entry.value
+
+    def on_close(self, cleanup):
+        self._cleanups.append(cleanup)
+
+    def close(self):
+        while self._cleanups:
+            self._cleanups.pop()()
+        self._cache.clear()
+        for m in self.modules():
+            for f in m.files():
+                f.close()
+        for f in self.misc:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def modules(self):
         return self._modules
 
@@ -154,6 +344,23 @@ class Project:
             if r.name == name:
                 yield from r.files()
 
+    def fingerprint(self):
+        """Hash of the contents of all files in the root and of the names of everything in it,
+        so that added extra files change the fingerprint too. Files of modules and misc files
+        outside of the root are hashed as well."""
+        h = hashlib.sha256()
+        files = {f.path: f for m in self.modules() for f in m.files()}
+        files.update((f.path, f) for f in self.misc)
+        entries = sorted(self.root.list()) if self.root.exists() else []
+        for path in entries:
+            if path.is_file() and path not in files:
+                files[path] = File(path.name, FileType.EXTRA, self.root)
+        for path in sorted(files):
+            h.update(f"{os.path.relpath(str(path), str(self.root))}:{files[path].hash()}\n".encode())
+        for path in entries:
+            h.update(f"{path.name}\n".encode())
+        return h.hexdigest()
+
     def __str__(self):
         return f"<Project {self.root}>"
 
@@ -1,24 +1,78 @@
+import json
+
+
 class Result:
+    __slots__ = ("penalty", "messages", "comments", "custom", "need_review")
+
+    # Version of the serialized form, bumped whenever it changes incompatibly
+    FORMAT_VERSION = 1
+
     def __init__(self, need_review=True):
         self.penalty = 0
         self.messages = []
         self.comments = []
-        self.custom = {} 
+        self.custom = {}
         self.need_review = need_review
 
     def __iadd__(self, other):
+        # Merging appends to the lists and dict of self, the ones of other are not copied
         self.penalty += other.penalty
-        self.messages += other.messages
-        self.comments += other.comments
-        self.custom = {**self.custom, **other.custom}
+        self.messages.extend(other.messages)
+        self.comments.extend(other.comments)
+        self.custom.update(other.custom)
         self.need_review |= other.need_review
         return self
 
     def __add__(self, other):
-        res = deepcopy(self)
+        res = self.copy()
         res += other
         return res
 
+    def copy(self):
+        res = Result(need_review=self.need_review)
+        res.penalty = self.penalty
+        res.messages = list(self.messages)
+        res.comments = list(self.comments)
+        res.custom = dict(self.custom)
+        return res
+
+    def __getstate__(self):
+        # Pickled as a plain tuple, which is what results sent back by worker processes cost
+        return (self.penalty, self.messages, self.comments, self.custom, self.need_review)
+
+    def __setstate__(self, state):
+        self.penalty, self.messages, self.comments, self.custom, self.need_review = state
+
+    def to_dict(self):
+        return {
+            "penalty": self.penalty,
+            "messages": self.messages,
+            "comments": self.comments,
+            "custom": self.custom,
+            "need_review": self.need_review,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        res = cls(need_review=d["need_review"])
+        res.penalty = d["penalty"]
+        res.messages = list(d["messages"])
+        res.comments = list(d["comments"])
+        res.custom = dict(d["custom"])
+        return res
+
+    def to_json(self):
+        """Serialized result for storage. The same result always gives the same text, and
+        custom values that JSON can't hold, like paths, are stored as their str()."""
+        return json.dumps({"version": self.FORMAT_VERSION, **self.to_dict()},
+                          sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
+    @classmethod
+    def from_json(cls, data):
+        d = json.loads(data)
+        if d.get("version", cls.FORMAT_VERSION) != cls.FORMAT_VERSION:
+            raise ValueError(f"Unsupported result format version: {d['version']}")
+        return cls.from_dict(d)
+
     def __str__(self):
         return f"<Result penalty: {self.penalty} comments: {'. '.join(self.comments)} messages: <{len(self.messages)} messages> need_review: {self.need_review}>"
-
@@ -48,6 +48,17 @@ def _enable_macros(cls):
 
 
 
+def _enable_prepare(cls):
+    # Reviewers may set up a project ahead of time, before it is passed to review
+    if not hasattr(cls, "prepare"):
+        def prepare(self, project, result):
+            pass
+
+        cls.prepare = prepare
+
+    return cls
+
+
 def reviewer(cls):
     assert hasattr(cls, "review") and callable(getattr(cls, "review"))
 
@@ -56,6 +67,7 @@ def reviewer(cls):
     _register_reviewer(cls.__name__[:-len("Reviewer")], cls)
 
     cls = _make_callable(cls)
+    cls = _enable_prepare(cls)
     cls = _enable_macros(cls)
 
     return cls
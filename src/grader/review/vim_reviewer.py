@@ -15,11 +15,15 @@ class VimReviewer:
     def __init__(self, config):
         with open(config["session"]) as f:
             self.template = f.read()
-    
+        self.rendered = {}
+
+    def prepare(self, project: Project, result: Result):
+        self.rendered[project.root] = self.render_result(result)
+
     def _create_session_file(self, project: Project, result: Result):
         session = self.template.replace("ROOT", project.root)
 
-        review, messages = self.render_result(result)
+        review, messages = self.rendered.pop(project.root, None) or self.render_result(result)
 
         self.review_file = self.exit_stack.enter_context(create_tempfile(review, mode="w+t"))
 
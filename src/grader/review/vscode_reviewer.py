@@ -7,6 +7,7 @@ from grader.util import create_tempfile, create_file
 
 from contextlib import ExitStack
 from enum import Enum
+from threading import Lock
 
 from tempfile import TemporaryDirectory
 
@@ -41,6 +42,14 @@ class VscodeReviewer:
         self._dir = TemporaryDirectory()
         self.dir = local.path(self._dir.name)
 
+        # Projects prepared ahead of time are staged outside of the directory open in the editor
+        self._staging_dir = TemporaryDirectory()
+        self.staging_dir = local.path(self._staging_dir.name)
+        self.staged = {}
+        self.retired = []
+        self.retired_count = 0
+        self.staging_lock = Lock()
+
         self.project_path = self.dir / "project"
         self.review_path = self.project_path / review_filename
         self.messages_path = self.project_path / messages_filename
@@ -74,6 +83,45 @@ class VscodeReviewer:
         b = bytes(s, "ascii")
         self.vscode_sock.send(b)
 
+    def _stage_project_dir(self, path, project_path, result):
+        copy(project_path, path)
+
+        review, messages = self.render_result(result)
+        create_file(path / self.review_path.name, review).close()
+        create_file(path / self.messages_path.name, messages).close()
+
+        for name, contents in result.custom.items():
+            create_file(path / name, contents).close()
+
+    def prepare(self, project: Project, result: Result):
+        with self.staging_lock:
+            retired, self.retired = self.retired, []
+        for path in retired:
+            delete(path)
+
+        path = self.staging_dir / project.root.name
+        delete(path)
+        self._stage_project_dir(path, project.root, result)
+        with self.staging_lock:
+            self.staged[project.root] = path
+
+    def _switch_to_staged(self, project: Project):
+        with self.staging_lock:
+            path = self.staged.pop(project.root, None)
+        if path is None:
+            return False
+
+        # Renames are instant, the previous project is deleted later while preparing the next one
+        self.retired_count += 1
+        retired = self.staging_dir / f".retired-{self.retired_count}"
+        self.project_path.move(retired)
+        path.move(self.project_path)
+        with self.staging_lock:
+            self.retired.append(retired)
+
+        self.review_file = open(self.review_path, "r+")
+        return True
+
     def _prepare_project_dir(self, project_path, result=None):
         delete(self.project_path)
         copy(project_path, self.project_path)
@@ -87,10 +135,10 @@ class VscodeReviewer:
         review, messages = self.render_result(result)
         
         self.review_file = create_file(self.review_path, review, mode="w+")
-        create_file(self.messages_path, messages)
+        create_file(self.messages_path, messages).close()
 
         for name, contents in result.custom.items():
-            create_file(self.project_path / name, contents)
+            create_file(self.project_path / name, contents).close()
 
 
     def _get_review(self):
@@ -103,10 +151,16 @@ class VscodeReviewer:
 
 
     def review(self, project: Project, result: Result):
-        self._prepare_project_dir(project.root, result)
-        self._send_string(project.root.name)
-        assert self._get_message() == VscodeCommand.REVIEW
-        return self._get_review()
+        if not self._switch_to_staged(project):
+            self._prepare_project_dir(project.root, result)
+        try:
+            self._send_string(project.root.name)
+            assert self._get_message() == VscodeCommand.REVIEW
+            return self._get_review()
+        finally:
+            # The next project gets a review file of its own
+            self.review_file.close()
+            self.review_file = None
 
 
 
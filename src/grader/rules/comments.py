@@ -3,17 +3,16 @@ from .rule import rule
 from grader.project import Project, File
 from grader.result import Result
 from grader.rules.decorators import occurence_counter, per_source_file, per_module, binary_rule
-from grader.util import get_symbols
+from grader.util import get_symbols, SymbolMatcher
 
 from grader.machine import with_machine_rule
 
 
-def get_symbol_comments(code_path, symbols):
+def get_symbol_comments(f, symbols):
     in_comment = False
     proper_comment = False
     comment_just_ended = False
 
-    level = 0
     param_tags = 0
     return_tags = 0
 
@@ -21,57 +20,56 @@ def get_symbol_comments(code_path, symbols):
     found_symbols = []
     messages = []
 
-    with open(code_path, "r") as f:
-        for l in f:
-            line = l.strip()
-            if line.startswith("//"):
-                continue
+    model = f.lexical_model()
+    matcher = SymbolMatcher(symbols)
+    for n in range(model.line_count()):
+        line = model.line(n).strip()
+        if line.startswith("//"):
+            continue
 
-            if len(line) == 0:
-                continue
+        if len(line) == 0:
+            continue
 
-            if not in_comment and line.startswith("/*"):
-                in_comment = True
-                proper_comment = (line == "/**")
+        if not in_comment and line.startswith("/*"):
+            in_comment = True
+            proper_comment = (line == "/**")
 
 
-            if in_comment:
-                param_tags += line.count("@param")
-                return_tags += line.count("@return")
-            else:
-                if level == 0:
-                    for s in symbols:
-                        if line.count(f"{s}(") == 1 or line.count(f"{s} (") == 1:
-                            found_symbols.append(s)
-
-                            if comment_just_ended:
-                                param_count = line.count(",") + 1
-                                if line.count("()") != 0 or line.count("( )") != 0 or line.count("( void )") != 0 or line.count("(void)") != 0:
-                                    param_count = 0
-
-                                tokens = line.split()
-                                return_type = "void" if (tokens[0] == "void" or tokens[1] == "void") else "type"
-
-                                comments[s] = {
-                                    "param_count": param_count,
-                                    "param_tags": param_tags,
-                                    "return_tags": return_tags,
-                                    "return_type": return_type,
-                                }
-
-                level += line.count("{") - line.count("}")
-
+        if in_comment:
+            param_tags += line.count("@param")
+            return_tags += line.count("@return")
+        else:
+            # Braces in strings and trailing comments do not count towards the level
+            if model.depth[n] == 0:
+                for s in matcher.calls(line):
+                    found_symbols.append(s)
+
+                    if comment_just_ended:
+                        param_count = line.count(",") + 1
+                        if line.count("()") != 0 or line.count("( )") != 0 or line.count("( void )") != 0 or line.count("(void)") != 0:
+                            param_count = 0
+
+                        tokens = line.split()
+                        return_type = "void" if (tokens[0] == "void" or tokens[1] == "void") else "type"
+
+                        comments[s] = {
+                            "param_count": param_count,
+                            "param_tags": param_tags,
+                            "return_tags": return_tags,
+                            "return_type": return_type,
+                        }
+
+            comment_just_ended = False
+            param_tags = 0
+            return_tags = 0
+            in_comment = False
+            proper_comment = False
+            
+        if line.endswith("*/"):
+            in_comment = False
+            comment_just_ended = True
+            if line.startswith("/*"):
                 comment_just_ended = False
-                param_tags = 0
-                return_tags = 0
-                in_comment = False
-                proper_comment = False
-                
-            if line.endswith("*/"):
-                in_comment = False
-                comment_just_ended = True
-                if line.startswith("/*"):
-                    comment_just_ended = False
 
     return {
         "comments": comments,
@@ -80,18 +78,18 @@ def get_symbol_comments(code_path, symbols):
     }
 
 
-def check_comments(source_path, header_path, machine=None, session=None):
-    assert source_path.endswith(".c")
-    if not source_path.exists():
-        return {"messages": [f"{source_path.name} does not exist"]}
+def check_comments(source, header, machine=None, session=None):
+    assert source.name.endswith(".c")
+    if not source.path.exists():
+        return {"messages": [f"{source.name} does not exist"]}
 
     explanation = []
     messages = []
 
-    symbols = get_symbols(source_path, machine, session)
+    symbols = get_symbols(source.path, machine, session)
 
-    header_res = get_symbol_comments(header_path, symbols) if header_path else None
-    source_res = get_symbol_comments(source_path, symbols)
+    header_res = get_symbol_comments(header, symbols) if header else None
+    source_res = get_symbol_comments(source, symbols)
 
     # messages.append(f"{os.path.basename(source_path)}: {source_res}")
     messages += source_res["messages"]
@@ -160,34 +158,49 @@ def check_comments(source_path, header_path, machine=None, session=None):
     }
 
 
+def get_comment_analysis(project, module):
+    """check_comments for the module, computed once per project for all rules that need it.
+    The key includes file contents, so edited files are analyzed again."""
+    source = module.sources[0]
+    key = ("comments", module.name, source.hash(), module.header.hash() if module.header else None)
+    return project.cached(key, lambda: check_comments(source, module.header))
+
+
 @rule
 @per_source_file(annotate_comments=True)
 class FileCommentRule:
+    cacheable = True
+
     def __init__(self, config):
         self.comment_penalty = config.get("missing_comment_penalty", 1)
         self.tag_penalty = config.get("tag_penalty", 0.5)
 
     def apply(self, f: File):
         res = Result()
-        with open(f.path, "r") as code:
-            c = code.read().strip()
-            if not c.startswith("/*"):
-                res.penalty += self.comment_penalty
-                res.comments.append("Missing file comment")
-            else:
-                if not c.count("@author") > 0:
-                    res.penalty += self.tag_penalty
-                    res.comments.append("Missing @author tag")
-                if not c.count("@file") == 1:
-                    res.penalty += self.tag_penalty
-                    res.comments.append("Missing @file tag")
+        model = f.lexical_model()
+        c = f.read()
+        # The file has to start with a block comment, before any code
+        first_comment = model.comments[0] if model.comments else None
+        if first_comment is None or not first_comment.block or not c.lstrip().startswith(first_comment.text):
+            res.penalty += self.comment_penalty
+            res.comments.append("Missing file comment")
+        else:
+            if not c.count("@author") > 0:
+                res.penalty += self.tag_penalty
+                res.comments.append("Missing @author tag")
+            if not c.count("@file") == 1:
+                res.penalty += self.tag_penalty
+                res.comments.append("Missing @file tag")
         return res
 
 
 @rule
-@per_module(annotate_comments=False)
+@per_module(annotate_comments=False, pass_project=True)
 @with_machine_rule
 class FunctionCommentsRule:
+    # Only reads the module files
+    default_workspace = "shared"
+
     def __init__(self, config):
         self.duplicate_comments_penalty = config.get("duplicate_comments_penalty", 0)
         self.comment_penalty = config.get("missing_comment_penalty", 1)
@@ -195,9 +208,9 @@ class FunctionCommentsRule:
         self.tag_penalty = config.get("missing_tag_penalty", 0.5)
         self.tag_penalty_limit = config.get("missing_tag_penalty_limit", 5)
 
-    def apply(self, module):
+    def apply(self, module, project):
         res = Result()
-        check = check_comments(module.sources[0].path, module.header.path if module.header else None)
+        check = get_comment_analysis(project, module)
         res.comments += check["explanation"]
         res.messages += check["messages"]
 
@@ -208,14 +221,16 @@ class FunctionCommentsRule:
 
 @rule
 @occurence_counter
-@per_module(annotate_comments=False)
+@per_module(annotate_comments=False, pass_project=True)
 class MisplacedCommentsRule:
+    cacheable = True
+
     def __init__(self, config):
         pass
 
-    def apply(self, module):
+    def apply(self, module, project):
         res = Result()
-        check = check_comments(module.sources[0].path, module.header.path if module.header else None)
+        check = get_comment_analysis(project, module)
 
         res.penalty = check["misplaced_comments"]
 
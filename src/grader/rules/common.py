@@ -3,16 +3,48 @@ from .rule import rule, construct_rule
 from grader.project import Project
 from grader.result import Result
 
+import grader.engine as engine
+import grader.profiling as profiling
+
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+
 
 @rule
 class CompoundRule:
     def __init__(self, config: dict):
         self.rules = [construct_rule(rule_config) for rule_config in config["rules"]]
+        self.concurrency = config.get("concurrency", 1)
 
     def apply(self, project: Project):
+        if self.concurrency > 1:
+            # Child rules are independent, so they can run side by side. Each runs on one
+            # thread at a time, machine rules keep their connection and work directory on the
+            # instance and lock it while applied. Results are still merged in rule order to
+            # keep comments and messages ordered as in sequential mode
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                results = list(pool.map(profiling.propagate(lambda r: r.apply(project)), self.rules))
+        else:
+            results = (r.apply(project) for r in self.rules)
+
+        return self._merge(results)
+
+    async def apply_async(self, project: Project):
+        # Same ordering and concurrency as apply, but rules with apply_async of their own
+        # wait on the engine loop instead of holding a thread
+        limit = asyncio.Semaphore(self.concurrency)
+
+        async def apply_child(r):
+            async with limit:
+                return await engine.apply_rule_async(r, project)
+
+        return self._merge(await asyncio.gather(*(apply_child(r) for r in self.rules)))
+
+    def _merge(self, results):
         res = Result(need_review=False)
-        for r in self.rules:
-            res += r.apply(project)
+        for r in results:
+            res += r
         return res
 
 
@@ -2,12 +2,17 @@ from .rule import rule
 
 from grader.rules.decorators import binary_rule
 
+from grader.artifacts import compile_object, link_executable
 from grader.machine import with_machine_rule
 from grader.result import Result
 
 from grader.util import get_object_file_name
 
+import grader.profiling as profiling
+
+from concurrent.futures import ThreadPoolExecutor
 from itertools import product
+from threading import Event
 
 @rule
 @binary_rule
@@ -18,43 +23,73 @@ class CompilationRule:
         self.cflags = config.get("cflags", "")
         self.ldflags = config.get("ldflags", "")
         self.modules = config["modules"]
+        self.parallelism = config.get("parallelism", 1)
+        self.stop_on_link_failure = config.get("stop_on_link_failure", False)
+
+    def _link(self, project, index, combo, object_keys, link_failed):
+        if self.stop_on_link_failure and link_failed.is_set():
+            return None
+
+        objects = [get_object_file_name(s) for s in combo]
+        # Combinations linked at the same time must not overwrite each other's executable
+        output = "a.out" if index is None else f"a.{index}.out"
+        build = link_executable(self, project, [object_keys[s] for s in combo], objects, self.compiler, self.ldflags, output)
+        if build.retcode:
+            link_failed.set()
+        return build
 
     def apply(self, project):
         res = Result()
         res.need_review = False
 
         modules = list(filter(lambda m: m.name in self.modules, project.modules()))
-        sources = [s.name for m in modules for s in m.sources]
+        # A source shared by several modules is compiled only once
+        sources = list({s.name: s for m in modules for s in m.sources}.values())
         source_combos = list(product(*[[s.name for s in m.sources] for m in modules]))
-        object_combos = list(map(lambda l: list(map(get_object_file_name, l)), source_combos))
 
+        with ThreadPoolExecutor(max_workers=self.parallelism) as pool:
+            compiled = list(pool.map(profiling.propagate(lambda s: compile_object(self, project, s, self.compiler, self.cflags)), sources))
+
+        object_keys = {}
         entire_message = ""
-        for s in sources:
-            cmd = f"{self.compiler} {self.cflags} -c -o {get_object_file_name(s)} {s}"
-            retcode, out, err = self.session.run(cmd, retcode=None)
-            if retcode or err.strip() != "" or out.strip() != "":
+        for s, (key, build) in zip(sources, compiled):
+            object_keys[s.name] = key
+            if build.retcode or build.err.strip() != "" or build.out.strip() != "":
                 res.need_review = True
 
-            if retcode:
+            if build.retcode:
                 res.penalty = True
                 res.comments.append("Didn't compile")
 
-            res.custom[f"COMPILATION_{s}"] = f"{cmd}\nstdout:\n{out}\nstderr:\n{err}\n\n"
-            entire_message += res.custom[f"COMPILATION_{s}"]
+            res.custom[f"COMPILATION_{s.name}"] = f"{build.command}\nstdout:\n{build.out}\nstderr:\n{build.err}\n\n"
+            entire_message += res.custom[f"COMPILATION_{s.name}"]
 
         if not res.penalty:
+            link_failed = Event()
+            with ThreadPoolExecutor(max_workers=self.parallelism) as pool:
+                indices = [None] if len(source_combos) == 1 else range(1, len(source_combos) + 1)
+                linked = list(pool.map(profiling.propagate(lambda args: self._link(project, *args, object_keys, link_failed)),
+                                       zip(indices, source_combos)))
+
             linker_result = ""
-            for c in object_combos:
-                cmd = f"{self.compiler} {self.ldflags} {' '.join(c)}"
-                retcode, out, err = self.session.run(cmd, retcode=None)
-                if retcode or err.strip() != "" or out.strip() != "":
+            skipped = 0
+            for build in linked:
+                if build is None:
+                    skipped += 1
+                    continue
+
+                if build.retcode or build.err.strip() != "" or build.out.strip() != "":
                     res.need_review = True
 
-                if retcode:
+                if build.retcode:
                     res.penalty = True
                     res.comments.append("Didn't link")
 
-                linker_result = linker_result + f"{cmd}\nstdout:\n{out}\nstderr:\n{err}\n\n"
+                linker_result = linker_result + f"{build.command}\nstdout:\n{build.out}\nstderr:\n{build.err}\n\n"
+
+            if skipped:
+                res.messages.append(f"{skipped} of {len(source_combos)} link combinations skipped after a link failure")
+                linker_result += f"{skipped} of {len(source_combos)} combinations skipped after a link failure\n"
 
             res.custom["COMPILATION_linker"] = linker_result
             entire_message += linker_result
@@ -62,4 +97,3 @@ class CompilationRule:
         res.custom["COMPILATION_combined"] = entire_message
             
         return res
-
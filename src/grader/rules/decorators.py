@@ -1,6 +1,8 @@
 from grader.project import Project
 from grader.result import Result
 
+import grader.profiling as profiling
+
 import traceback
 
 def _per_object(obj_type, annotate_comments, annotate_messages, pass_project):
@@ -27,10 +29,11 @@ def _per_object(obj_type, annotate_comments, annotate_messages, pass_project):
             res = Result(need_review=False)
             for o in getter(project):
                 try:
-                    if pass_project:
-                        obj_res = old_apply(self, o, project)
-                    else:
-                        obj_res = old_apply(self, o)
+                    with profiling.span(f"{cls.__name__} {o.name}", "object", rule=cls.__name__, object=o.name):
+                        if pass_project:
+                            obj_res = old_apply(self, o, project)
+                        else:
+                            obj_res = old_apply(self, o)
                     if self.per_obj_penalty_limit >= 0:
                         obj_res.penalty = min(obj_res.penalty, self.per_obj_penalty_limit)
 
@@ -8,20 +8,25 @@ from grader.util import get_symbols, get_relocations
 @occurence_counter
 @per_module(pass_project=True)
 class StaticSymbolsRule:
+    cacheable = True
+
     def __init__(self, config):
         self.whitelist = config["whitelist"]
         self.check_variables = config.get("check_variables", False)
+        # Objects built by CompilationRule are reused if these match its settings
+        self.compiler = config.get("compiler", "gcc")
+        self.cflags = config.get("cflags", "")
 
     def apply(self, module, project):
         res = Result()
 
-        symbols = get_symbols(module.source.path)
+        symbols = get_symbols(module.source.path, compiler=self.compiler, cflags=self.cflags)
 
         relocations = set()
         for m in project.modules():
             if m is not module:
                 try:
-                    relocations |= get_relocations(m.source.path)
+                    relocations |= get_relocations(m.source.path, compiler=self.compiler, cflags=self.cflags)
                 except RuntimeError as e:
                     res.messages.append(f"Failed to get relocations for {m.name}: {e}")
 
@@ -43,12 +48,16 @@ class StaticSymbolsRule:
 @rule
 @per_module(annotate_comments=False)
 class RequiredFunctionsRule:
+    cacheable = True
+
     def __init__(self, config):
         self.symbols = config["symbols"]
+        self.compiler = config.get("compiler", "gcc")
+        self.cflags = config.get("cflags", "")
 
     def apply(self, module):
         res = Result()
-        symbols = get_symbols(module.source.path)
+        symbols = get_symbols(module.source.path, compiler=self.compiler, cflags=self.cflags)
 
         found = set(symbols.keys())
 
@@ -6,6 +6,8 @@ from grader.result import Result
 
 @rule
 class DummyRule:
+    cacheable = True
+
     def __init__(self, config: dict):
         self.desired = config["desired"]
 
@@ -8,6 +8,8 @@ from grader.rules.decorators import occurence_counter, binary_rule, skip_review_
 @skip_review_on_good
 @occurence_counter
 class ResourceSetCountRule:
+    cacheable = True
+
     def __init__(self, config: dict):
         self.name = config["resource_name"]
 
@@ -27,6 +29,8 @@ class ResourceSetCountRule:
 @skip_review_on_good
 @binary_rule
 class FilePresentRule:
+    cacheable = True
+
     def __init__(self, config: dict):
         self.name = config["name"]
 
@@ -49,6 +53,8 @@ class FilePresentRule:
 @skip_review_on_good
 @occurence_counter
 class ExtraFilesRule:
+    cacheable = True
+
     def __init__(self, config: dict):
         pass
 
@@ -71,6 +77,8 @@ class ExtraFilesRule:
 
 @rule
 class LsRule:
+    cacheable = True
+
     def __init__(self, config: dict):
         pass
 
@@ -2,7 +2,10 @@ from .rule import rule
 
 from grader.result import Result
 
-from grader.machine import with_machine_rule
+from grader.machine import with_machine_rule, popen_in_workdir
+from grader.sandbox import sandbox_command, usage_path, read_usage, format_usage
+
+from plumbum.machines.session import ShellSession
 
 from enum import Enum
 
@@ -85,12 +88,12 @@ class FileStatGetter:
 
         self.has_ns = hasattr(stat, "st_mtime_ns")
 
-    def get_cwd_stats_dict(self):
+    def get_stats_dict(self, path):
         if self.has_ns:
-            return {f.name: f.stat().st_mtime_ns for f in self.machine.cwd.list()}
+            return {f.name: f.stat().st_mtime_ns for f in path.list()}
         else:
             time.sleep(1)
-            return {f.name: f.stat().st_mtime for f in self.machine.cwd.list()}
+            return {f.name: f.stat().st_mtime for f in path.list()}
 
 
 @rule
@@ -98,23 +101,50 @@ class FileStatGetter:
 class MakefileRule:
     def __init__(self, config):
         self.steps = [Step(s, i) for i, s in enumerate(config["steps"], 1)]
-        self.stat_getter = FileStatGetter(self.machine)
+
+    def _open_shell(self, stats_path):
+        """Shell in the sandbox that runs all steps, since they run the student's Makefile.
+        Steps share it, so directory changes and variables of a step carry over to the
+        next ones, like they did in the session of the rule."""
+        cmd = sandbox_command(self.sandbox, ["sh"], stats_path)
+        proc = popen_in_workdir(self.machine, self.workdir, f"exec {cmd}")
+        return proc, ShellSession(proc, self.machine.custom_encoding)
+
+    def _close_shell(self, proc):
+        # End of input makes the shell exit, after which the sandbox writes its report
+        if hasattr(proc, "channel"):
+            proc.channel.shutdown_write()
+        else:
+            proc.stdin.close()
+        proc.wait()
+        for pipe in (proc.stdout, proc.stderr):
+            pipe.close()
 
     def apply(self, project):
         res = Result()
 
+        stats_path = usage_path(self.workdir)
+        proc, shell = self._open_shell(stats_path)
+        try:
+            return self._run_steps(shell, FileStatGetter(self.machine), res)
+        finally:
+            self._close_shell(proc)
+            # Resources are used by all steps together
+            res.custom["MAKEFILE_resources"] = f"All steps: {format_usage(read_usage(stats_path))}\n"
+
+    def _run_steps(self, shell, stat_getter, res):
         for s in self.steps:
             if s.updates is None:
-                self.session.run(s.command)
+                shell.run(s.command)
                 continue
 
-            before = self.stat_getter.get_cwd_stats_dict()
+            before = stat_getter.get_stats_dict(self.workdir)
 
-            retcode, out, err = self.session.run(s.command, retcode=None)
+            retcode, out, err = shell.run(s.command, retcode=None)
             if retcode != 0:
                 res.messages.append(f"Step {s.index} failed: exit code {retcode}\nstdout:\n{out}\nstderr:\n{err}\n")
                 return res
-            after = self.stat_getter.get_cwd_stats_dict()
+            after = stat_getter.get_stats_dict(self.workdir)
             for u in s.updates:
                 if u.type == UpdateType.CREATE:
                     if not (u.file not in before and u.file in after):
@@ -1,10 +1,16 @@
 from copy import deepcopy
 
+import grader.cache as cache
+import grader.profiling as profiling
+
+from grader.cache import hash_key
 from grader.project import Project
 from grader.result import Result
 from grader.scope import Scope
 from grader.util import camel_to_snake_case
 
+import json
+import os
 import traceback
 
 # Enable automatic rule registration
@@ -57,17 +63,104 @@ def add_review_skip(cls):
     old_apply = cls.apply
     def new_apply(self, project, *args, **kwargs):
         res = old_apply(self, project, *args, **kwargs)
-        if self.skip_review_without_penalty:
-            res.need_review = bool(res.penalty) or bool(res.messages) or bool(res.comments)
-        else:
-            if res.need_review is None:
-                res.need_review = True
+        _update_need_review(self, res)
+        return res
+    cls.apply = new_apply
+
+    return cls
+
+
+def _update_need_review(rule, res):
+    if rule.skip_review_without_penalty:
+        res.need_review = bool(res.penalty) or bool(res.messages) or bool(res.comments)
+    else:
+        if res.need_review is None:
+            res.need_review = True
+
+
+_grader_version = None
+
+
+def _get_grader_version():
+    """Hash of the sources of the whole grader package. Rules depend on helpers, decorators
+    and the project model, so results computed by any older version must not be reused."""
+    global _grader_version
+    if _grader_version is None:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        sources = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.endswith(".py"):
+                    path = os.path.join(dirpath, name)
+                    with open(path, "rb") as f:
+                        sources += [os.path.relpath(path, root), f.read()]
+        _grader_version = hash_key(*sources)
+    return _grader_version
+
+
+def add_result_cache(cls):
+    """Caches results on disk for rules that only depend on their config and the project
+    files, so never for rules running anything on a machine. Rules opt in with a cacheable class attribute, and the cache_results config
+    option overrides it for a single rule."""
+    old_init = cls.__init__
+    def new_init(self, config):
+        old_init(self, config)
+
+        self.cache_results = config.get("cache_results", getattr(cls, "cacheable", False))
+        self.cache_key = hash_key(cls.__name__, _get_grader_version(), json.dumps(config, sort_keys=True, default=str))
+
+    cls.__init__ = new_init
+
+    old_apply = cls.apply
+    def new_apply(self, project, *args, **kwargs):
+        if not self.cache_results or not cache.get_cache_config().get("results", True):
+            return old_apply(self, project, *args, **kwargs)
+
+        key = hash_key(self.cache_key, project.cached(("fingerprint",), project.fingerprint))
+        results = cache.get_cache("results")
+        data = results.get(key)
+        if data is not None:
+            return Result.from_json(data.decode())
+
+        res = old_apply(self, project, *args, **kwargs)
+        results.put(key, res.to_json().encode())
         return res
     cls.apply = new_apply
 
     return cls
 
 
+def add_profiling(cls):
+    old_apply = cls.apply
+    def new_apply(self, project, *args, **kwargs):
+        with profiling.span(cls.__name__, "rule"):
+            return old_apply(self, project, *args, **kwargs)
+    cls.apply = new_apply
+
+    return cls
+
+
+def add_async_apply(cls):
+    """Wraps apply_async of rules that can be awaited on the engine loop the same way
+    the decorators above wrap apply. Results of apply_async are never cached."""
+    old_apply_async = cls.apply_async
+    async def new_apply_async(self, project):
+        with profiling.span(cls.__name__, "rule"):
+            try:
+                res = await old_apply_async(self, project)
+                if self.penalty_limit >= 0:
+                    res.penalty = min(res.penalty, self.penalty_limit)
+            except Exception:
+                res = Result(need_review=True)
+                res.messages.append(f"Execution of rule {cls.__name__} failed at {project}:\n{traceback.format_exc()}")
+            _update_need_review(self, res)
+            return res
+    cls.apply_async = new_apply_async
+
+    return cls
+
+
 def rule(cls):
     assert hasattr(cls, "apply") and callable(getattr(cls, "apply"))
 
@@ -75,8 +168,12 @@ def rule(cls):
         raise ValueError(f"invalid rule class name: {name}. Rule class names should end with 'Rule'")
     _register_rule(cls.__name__[:-len("Rule")], cls)
 
+    cls = add_result_cache(cls)
     cls = add_penalty_limit(cls)
     cls = add_review_skip(cls)
+    cls = add_profiling(cls)
+    if hasattr(cls, "apply_async"):
+        cls = add_async_apply(cls)
 
     def call(self, *args, **kwargs):
         return self.apply(*args, **kwargs)
@@ -2,7 +2,7 @@ from .rule import rule
 
 from grader.project import File
 from grader.result import Result
-from grader.util import get_c_without_comments, get_symbols
+from grader.util import get_symbols, SymbolMatcher
 from grader.rules.decorators import per_source_file, occurence_counter
 
 import re
@@ -23,6 +23,8 @@ def find_magic_number(line):
 @rule
 @per_source_file(annotate_comments=False)
 class MagicNumbersRule:
+    cacheable = True
+
     def __init__(self, config):
         self.whitelist = config.get("whitelist", [0, 1])
         self.skip_markers = config.get("skip_markers", [])
@@ -30,20 +32,19 @@ class MagicNumbersRule:
 
     def apply(self, f: File):
         res = Result()
-        clean_code = get_c_without_comments(f)
+        model = f.lexical_model()
         magic_numbers = set()
 
-        for i, l in enumerate(clean_code.split('\n'), 1):
-            skip = False
-            for m in self.skip_markers:
-                if l.count(m) > 0:
-                    skip = True
-                    break
-            if skip:
+        # Digits the pattern below can match are in number, string and character literals,
+        # so other lines are not searched
+        lines = sorted({t.line for t in model.tokens if t.kind in ("number", "string", "char")})
+        for i in lines:
+            l = model.code_lines[i].strip()
+            if any(l.count(m) > 0 for m in self.skip_markers):
                 continue
 
             for magic in self._find_magic_numbers(l):
-                res.messages.append(f"Magic number {magic} at line {i}")
+                res.messages.append(f"Magic number {magic} at line {i + 1}")
                 magic_numbers.add(magic)
 
         if self.penalty:
@@ -66,12 +67,14 @@ class MagicNumbersRule:
 @occurence_counter
 @per_source_file(annotate_comments=False)
 class LineEndingsRule:
+    cacheable = True
+
     def __init__(self, config):
         pass
 
     def apply(self, f: File):
         res = Result()
-        res.penalty = f.read().count("\r")
+        res.penalty = f.lexical_model().cr_count
         if res.penalty:
             res.comments.append(f"Invalid line endings found")
             res.messages.append(f"{res.penalty} carriage returns found")
@@ -82,12 +85,14 @@ class LineEndingsRule:
 @per_source_file(annotate_comments=False)
 @occurence_counter
 class HardTabsRule:
+    cacheable = True
+
     def __init__(self, config):
         pass
 
     def apply(self, f: File):
         res = Result()
-        res.penalty = f.read().count("\t")
+        res.penalty = f.lexical_model().tab_count
         if res.penalty:
             res.comments.append(f"Hard tabs found")
             res.messages.append(f"{res.penalty} hard tabs found")
@@ -97,6 +102,8 @@ class HardTabsRule:
 @rule
 @per_source_file()
 class LastLineEndingRule:
+    cacheable = True
+
     def __init__(self, config):
         pass
 
@@ -113,40 +120,42 @@ class LastLineEndingRule:
 @occurence_counter
 @per_source_file(annotate_comments=False)
 class CurlyBracesRule:
+    cacheable = True
+
     def __init__(self, config):
-        pass
+        self.compiler = config.get("compiler", "gcc")
+        self.cflags = config.get("cflags", "")
 
     def apply(self, f: File):
         res = Result()
-        symbols = get_symbols(f.path) if f.name.endswith(".c") else {}
+        symbols = get_symbols(f.path, compiler=self.compiler, cflags=self.cflags) if f.name.endswith(".c") else {}
         symbols = {n: i for n, i in symbols.items() if i["type"] == "STT_FUNC" }
 
         level = 0
         bad_function = 0
         bad_other = 0
 
-        def has_func_name(l):
-            for s in symbols:
-                if l.count(s) > 0:
-                    return True
-            return False
+        has_func_name = SymbolMatcher(symbols).contains
 
+        model = f.lexical_model()
         prev_function = False
-        clean_code = get_c_without_comments(f)
-        for l in clean_code.split('\n'):
-            for i, c in enumerate(l):
-                if c == '{':
+        for l, tokens in zip(model.code_lines, model.line_tokens()):
+            for t in tokens:
+                if t.kind != "punct":
+                    continue
+
+                if t.text == '{':
                     level += 1
 
-                    if level == 1 and has_func_name(l[:i]):
+                    if level == 1 and has_func_name(l[:t.col]):
                         bad_function += 1
                     else:
-                        if (not l[:i] or l[:i].isspace()) and not prev_function:
+                        if (not l[:t.col] or l[:t.col].isspace()) and not prev_function:
                             bad_other += 1
-                elif c == '}':
+                elif t.text == '}':
                     level -= 1
             prev_function = has_func_name(l)
-                    
+
         if bad_function:
             res.comments.append("Bad curly braces in function definitions found")
             res.messages.append(f"Bad function curly braces: {bad_function}")
@@ -2,55 +2,276 @@ from .rule import rule
 
 from grader.rules.decorators import occurence_counter
 
-from grader.machine import with_machine_rule
+from grader.artifacts import compile_object, link_executable
+from grader.machine import with_machine_rule, popen_in_workdir
 from grader.result import Result
+from grader.sandbox import sandbox_argv, sandbox_command, usage_path, read_usage, format_usage
+from grader.util import get_object_file_name
+
+import grader.engine as engine
+import grader.profiling as profiling
 
 from plumbum.path.utils import copy
 
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio
+import os
+
+
+_CHUNK_SIZE = 64 * 1024
+_MAX_LINE = 80
+
+
+def _show_line(line):
+    line = line[:_MAX_LINE].decode(errors="replace")
+    return repr(line)
+
+
+class OutputComparator:
+    """Compares output arriving in chunks with the expected bytes. feed returns False once
+    reading can stop, at the first difference or when more than limit bytes arrived.
+    failure is None if the output was equal, otherwise a description of the first
+    differing line."""
+    def __init__(self, expected, limit=None):
+        self.expected = expected
+        self.limit = limit
+        self.pos = 0
+        self.line = 1
+        self.line_start = 0
+        self.actual_line = b""
+        self.failure = None
+        self.done = False
+
+    def feed(self, chunk):
+        if self.limit is not None and self.pos + len(chunk) > self.limit:
+            self.failure = f"output exceeds {self.limit} bytes"
+            self.done = True
+            return False
+
+        part = bytes(self.expected[self.pos:self.pos + len(chunk)])
+        end = len(chunk)
+        if part != chunk:
+            end = len(os.path.commonprefix([part, chunk]))
+
+        self.line += chunk.count(b"\n", 0, end)
+        nl = chunk.rfind(b"\n", 0, end)
+        if nl != -1:
+            self.line_start = self.pos + nl + 1
+            self.actual_line = chunk[nl + 1:end][:_MAX_LINE]
+        else:
+            self.actual_line = (self.actual_line + chunk[:end])[:_MAX_LINE]
+
+        if end != len(chunk):
+            self.actual_line += chunk[end:].split(b"\n", 1)[0]
+            self._fail()
+            return False
+        self.pos += len(chunk)
+        return True
+
+    def finish(self):
+        """Called once the output ended, returns failure"""
+        if not self.done and self.pos != len(self.expected):
+            self._fail()
+        self.done = True
+        return self.failure
+
+    def _fail(self):
+        start = self.line_start
+        expected_line = bytes(self.expected[start:start + _MAX_LINE + len(self.actual_line)]).split(b"\n", 1)[0]
+        self.failure = f"diff at line {self.line}: expected {_show_line(expected_line)}, got {_show_line(self.actual_line)}"
+        self.done = True
+
+
+def compare_output(chunks, expected, limit=None):
+    """Compares output arriving in chunks with the expected bytes and stops reading at the
+    first difference or once limit bytes were read. Returns None if they are equal,
+    otherwise a description of the first differing line."""
+    comparator = OutputComparator(expected, limit)
+    for chunk in chunks:
+        if not comparator.feed(chunk):
+            break
+    return comparator.finish()
+
+
+def _read_chunk(proc):
+    # Whatever output is available, instead of waiting until a whole chunk arrived
+    channel = getattr(proc, "channel", None)
+    if channel is not None:
+        return channel.recv(_CHUNK_SIZE)
+    return proc.stdout.read1(_CHUNK_SIZE)
+
+
+def _stop(proc):
+    """Stops a test program whose output was rejected. Remote processes can't be signaled,
+    but the sandbox kills the program once the reader of its output is gone."""
+    if hasattr(proc, "channel"):
+        proc.close()
+    else:
+        proc.terminate()
+
+
 @rule
 @occurence_counter
 @with_machine_rule
 class TestRule:
     def __init__(self, config):
-        self.build_command = config["build_command"]
+        # A structured build description lets the rule reuse objects and executables
+        # built by other rules, while a build command always runs from scratch
+        self.build = config.get("build")
+        self.build_command = config["build_command"] if self.build is None else None
         self.input_set_name = config["inputs"]
         self.output_set_name = config["outputs"]
         self.retcode = config.get("retcode", 0)
+        self.timeout = config.get("timeout", 1)
+        self.parallelism = config.get("parallelism", 1)
+        self.output_limit = config.get("output_limit", 16 * 1024 * 1024)
+        # Programs run in the work directory, like they always did. Tests that run at the
+        # same time get a scratch directory each instead, so that files created by one
+        # don't end up in the others. Programs opening files of the project by a relative
+        # path need scratch_dirs set to false.
+        self.scratch_dirs = config.get("scratch_dirs")
+
+    def _test_dir(self, index):
+        # Tests without an index run in the work directory
+        if index is None:
+            return self.workdir
+        test_dir = self.workdir / "tests" / str(index)
+        test_dir.mkdir()
+        return test_dir
+
+    def _outcome(self, inp, retcode, failure, stopped, stats_path):
+        usage = read_usage(stats_path)
+
+        # The exit status of a program stopped for its output says nothing
+        if retcode != self.retcode and not stopped:
+            return f"{inp.name} failed: retcode {retcode}", usage
+
+        if failure is not None:
+            return f"{inp.name} failed: {failure}", usage
+
+        return None, usage
+
+    def _run_test(self, index, inp, exp):
+        test_dir = self._test_dir(index)
+        executable = self.workdir / "a.out"
+        stats_path = usage_path(self.workdir)
+        cmd = sandbox_command(self.sandbox, [str(executable)], stats_path, wall_time=self.timeout)
+        proc = popen_in_workdir(self.machine, test_dir, f"exec {cmd} < {self.workdir / inp.name} 2>/dev/null")
+
+        # Output is compared as it arrives, and a program writing wrong or endless output is
+        # stopped instead of reading all it writes until the timeout. Outputs are compared
+        # byte for byte, like diff does.
+        comparator = OutputComparator(exp.view(), self.output_limit)
+        stopped = False
+        try:
+            while True:
+                chunk = _read_chunk(proc)
+                if not chunk:
+                    break
+                if not comparator.feed(chunk):
+                    stopped = True
+                    _stop(proc)
+                    break
+        finally:
+            proc.stdout.close()
+        retcode = proc.wait()
+        proc.stdin.close()
+        proc.stderr.close()
+
+        return self._outcome(inp, retcode, comparator.finish(), stopped, stats_path)
+
+    async def _run_test_async(self, index, inp, exp):
+        test_dir = self._test_dir(index)
+        stats_path = usage_path(self.workdir)
+        argv = sandbox_argv(self.sandbox, [str(self.workdir / "a.out")], stats_path, wall_time=self.timeout)
+        comparator = OutputComparator(exp.view(), self.output_limit)
+        stopped = False
+
+        profiling.count("subprocesses")
+        async with engine.get_engine().subprocesses:
+            with open(self.workdir / inp.name, "rb") as stdin:
+                proc = await engine.start_streaming(argv, str(test_dir), stdin)
+            try:
+                while True:
+                    chunk = await proc.read(_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if not comparator.feed(chunk):
+                        stopped = True
+                        proc.terminate()
+                        break
+            finally:
+                proc.close_output()
+            retcode = await proc.wait()
+
+        return self._outcome(inp, retcode, comparator.finish(), stopped, stats_path)
+
+    async def _run_tests_async(self, indices, tests):
+        return await asyncio.gather(*(self._run_test_async(i, inp, exp) for i, (inp, exp) in zip(indices, tests)))
+
+    def _build_executable(self, project):
+        compiler = self.build.get("compiler", "gcc")
+        modules = [m for m in project.modules() if m.name in self.build["modules"]]
+
+        object_keys = []
+        for m in modules:
+            key, build = compile_object(self, project, m.source, compiler, self.build.get("cflags", ""))
+            if build.retcode:
+                return build.retcode
+            object_keys.append(key)
+
+        objects = [get_object_file_name(m.source.name) for m in modules]
+        build = link_executable(self, project, object_keys, objects, compiler, self.build.get("ldflags", ""))
+        return build.retcode
 
     def apply(self, project):
         res = Result()
 
-        retcode, _, _ = self.session.run(self.build_command, retcode=None)
+        if self.build is not None:
+            retcode = self._build_executable(project)
+        else:
+            retcode, _, _ = self.session.run(self.build_command, retcode=None)
         if retcode:
             res.penalty = 10000
             res.comments.append("Program didn't compile")
             res.messages.append(f"compilation command exited with exit code {retcode}")
             return res
 
+        tests = list(zip(project.resource_set_files(self.input_set_name),
+                project.resource_set_files(self.output_set_name)))
+
+        # Inputs may be missing from the work directory when only some files are copied
+        for inp, _ in tests:
+            if not (self.workdir / inp.name).exists():
+                copy(inp.path, self.workdir / inp.name)
+
+        use_engine = self.machine_type == "local" and engine.is_enabled()
+        scratch_dirs = self.scratch_dirs
+        if scratch_dirs is None:
+            scratch_dirs = use_engine or self.parallelism > 1
+        indices = range(1, len(tests) + 1) if scratch_dirs else [None] * len(tests)
+
+        if use_engine:
+            # All tests are started at once, the engine limits how many run at the same time
+            outcomes = engine.get_engine().run(self._run_tests_async(indices, tests))
+        else:
+            with ThreadPoolExecutor(max_workers=self.parallelism) as pool:
+                outcomes = list(pool.map(profiling.propagate(lambda t: self._run_test(t[0], *t[1])), zip(indices, tests)))
+
         failed_tests = []
-        for inp, exp in zip(project.resource_set_files(self.input_set_name),
-                project.resource_set_files(self.output_set_name)):
-            cwd = self.machine.cwd
-            copy(inp.path, self.machine.cwd)
-            copy(exp.path, self.machine.cwd)
-
-            retcode, _, _ = self.session.run(f"timeout 1s ./a.out < {cwd / inp.name} > {cwd / 'output'}", retcode=None)
-            if retcode != self.retcode:
+        usage_report = ""
+        for (inp, _), (failure, usage) in zip(tests, outcomes):
+            usage_report += f"{inp.name}: {format_usage(usage)}\n"
+            if failure is not None:
                 res.penalty += 1
-                res.messages.append(f"{inp.name} failed: retcode {retcode}")
+                res.messages.append(failure)
                 failed_tests.append(inp.name)
-                continue
 
-            retcode, _, _ = self.session.run(f"diff {cwd / 'output'} {cwd / exp.name}", retcode=None)
-            if retcode:
-                res.penalty += 1
-                res.messages.append(f"{inp.name} failed: diff")
-                failed_tests.append(inp.name)
-                continue
+        res.custom["TEST_resources"] = usage_report
 
         if len(failed_tests):
             res.comments += [f"{t} failed" for t in failed_tests]
         else:
             res.need_review = False
         return res
-
@@ -0,0 +1,73 @@
+import json
+import math
+import os
+import shlex
+import uuid
+
+
+with open(os.path.join(os.path.dirname(__file__), "sandbox_runner.py")) as f:
+    _RUNNER_SOURCE = f.read()
+
+
+class SandboxLimits:
+    """Resource limits for student code run by machine rules, set with setrlimit by
+    sandbox_runner.py on the machine that runs it.
+
+    The process limit applies to all processes of the user on that machine, so it is off
+    by default. The memory limit caps the address space, which programs built with
+    -fsanitize=address can't run under, so it is off by default as well. Programs failing
+    to allocate memory fail in their own way, so hitting it isn't reported as a limit.
+    Everything the command spawns is killed when it exits or times out.
+    """
+    def __init__(self, config):
+        self.cpu_time = config.get("cpu_time", 10)
+        self.memory_mb = config.get("memory_mb")
+        self.file_size_mb = config.get("file_size_mb", 64)
+        self.processes = config.get("processes")
+        self.wall_time = config.get("wall_time")
+        self.python = config.get("python", "python3")
+
+    def rlimits(self, wall_time=None):
+        limits = {
+            "cpu_time": math.ceil(self.cpu_time) if self.cpu_time else None,
+            "address_space": self.memory_mb * 1024 * 1024 if self.memory_mb else None,
+            "file_size": self.file_size_mb * 1024 * 1024 if self.file_size_mb else None,
+            "processes": self.processes,
+            "wall_time": wall_time if wall_time is not None else self.wall_time,
+        }
+        return {name: value for name, value in limits.items() if value}
+
+
+def usage_path(workdir):
+    """Path for the usage report of one sandboxed command, outside of the work directory
+    so that rules looking at its files don't see it"""
+    return workdir.dirname / f".usage-{uuid.uuid4().hex}.json"
+
+
+def sandbox_argv(limits, argv, stats_path, wall_time=None):
+    """Command line running argv in the sandbox. The exit status is the one of argv,
+    128 + signal number if it was killed, or 124 if it ran out of wall time."""
+    return [limits.python, "-c", _RUNNER_SOURCE, str(stats_path), json.dumps(limits.rlimits(wall_time)), "--", *argv]
+
+
+def sandbox_command(limits, argv, stats_path, wall_time=None):
+    """sandbox_argv as a shell command"""
+    return " ".join(map(shlex.quote, sandbox_argv(limits, argv, stats_path, wall_time)))
+
+
+def read_usage(stats_path):
+    """Reads and removes the usage report, or returns None if the sandbox did not write one"""
+    if not stats_path.exists():
+        return None
+    usage = json.loads(stats_path.read())
+    stats_path.delete()
+    return usage
+
+
+def format_usage(usage):
+    if usage is None:
+        return "no usage report"
+    s = f"cpu {usage['cpu_time']:.3f}s, wall {usage['wall_time']:.3f}s, peak rss {usage['max_rss_kb']} KiB"
+    if usage["limit"]:
+        s += f", {usage['limit']} limit hit"
+    return s
@@ -0,0 +1,175 @@
+"""Runs a command with resource limits and writes its resource usage to a JSON file.
+
+usage: python3 -c <this file> STATS_PATH LIMITS_JSON -- COMMAND [ARGS...]
+
+The script is sent to the machine that runs the command as the -c argument of the
+interpreter, so it must not import anything from grader.
+"""
+import json
+import os
+import resource
+import select
+import signal
+import sys
+import time
+
+
+_RLIMITS = {
+    "cpu_time": resource.RLIMIT_CPU,
+    "address_space": resource.RLIMIT_AS,
+    "file_size": resource.RLIMIT_FSIZE,
+    "processes": resource.RLIMIT_NPROC,
+}
+
+# Exit status of timeout(1), which the sandbox replaces
+_TIMEOUT_RETCODE = 124
+
+# Signals stopping the sandbox, and everything it runs with it
+_STOP_SIGNALS = {signal.SIGTERM, signal.SIGHUP}
+
+
+def _run_child(command, limits):
+    # The child gets its own process group, so that everything it spawns can be killed at once
+    os.setsid()
+    # Python ignores these, and ignored signals stay ignored across exec
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    signal.signal(signal.SIGXFSZ, signal.SIG_DFL)
+    # The signal mask is inherited across exec as well
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, _STOP_SIGNALS)
+    for name, value in limits.items():
+        _, hard = resource.getrlimit(_RLIMITS[name])
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        resource.setrlimit(_RLIMITS[name], (value, value))
+    os.execvp(command[0], command)
+
+
+def _kill_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _kill(pid):
+    """Kills the child and its process group. The child itself is killed as well, as it may
+    not have a group of its own yet. Only called before the child is reaped, so that its
+    pid can't belong to another process."""
+    _kill_group(pid)
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _wait(pid):
+    """Waits for the child to exit, leaving it to be reaped by the caller. The child is
+    killed when the reader of our stdout, which the child shares, goes away, so that a
+    program whose output is no longer read stops even if it doesn't write anymore. This
+    also works for programs started over SSH, which can't be signaled."""
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_w, False)
+    # SIGCHLD interrupts the poll below through the wakeup fd
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.set_wakeup_fd(wakeup_w)
+
+    poller = select.poll()
+    # Only errors and hangups are reported for stdout, there is nothing to read from it
+    poller.register(1, 0)
+    poller.register(wakeup_r, select.POLLIN)
+    while True:
+        if os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None:
+            return
+        for fd, events in poller.poll():
+            if fd == wakeup_r:
+                os.read(wakeup_r, 4096)
+                continue
+            if events & (select.POLLERR | select.POLLHUP):
+                _kill(pid)
+            # Nothing more to learn from stdout, and a closed one is reported on every poll
+            poller.unregister(1)
+
+
+def _limit_hit(status, cpu_time, limits, timed_out):
+    if timed_out:
+        return "wall_time"
+
+    sig = None
+    if os.WIFSIGNALED(status):
+        sig = os.WTERMSIG(status)
+    elif os.WEXITSTATUS(status) > 128:
+        # A shell reports the signal that killed its last command this way
+        sig = os.WEXITSTATUS(status) - 128
+    if sig == signal.SIGXFSZ:
+        return "file_size"
+    if "cpu_time" in limits and (sig == signal.SIGXCPU or sig == signal.SIGKILL and cpu_time >= limits["cpu_time"]):
+        return "cpu_time"
+    # A failed allocation can't be told apart from other failures of the program, so the
+    # address space limit is never reported
+    return None
+
+
+def main():
+    stats_path = sys.argv[1]
+    limits = json.loads(sys.argv[2])
+    command = sys.argv[4:]
+    wall_time = limits.pop("wall_time", None)
+
+    # A stop signal arriving while the child starts is only handled once there is a child
+    # to kill, instead of killing the sandbox and leaving the child running
+    signal.pthread_sigmask(signal.SIG_BLOCK, _STOP_SIGNALS)
+    start = time.monotonic()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _run_child(command, limits)
+        finally:
+            os._exit(127)
+
+    timed_out = False
+    def on_timeout(signum, frame):
+        nonlocal timed_out
+        timed_out = True
+        _kill(pid)
+
+    if wall_time:
+        signal.signal(signal.SIGALRM, on_timeout)
+        signal.setitimer(signal.ITIMER_REAL, wall_time)
+    # Stopping the sandbox stops everything it runs
+    for signum in _STOP_SIGNALS:
+        signal.signal(signum, lambda signum, frame: _kill(pid))
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, _STOP_SIGNALS)
+
+    _wait(pid)
+    # Nothing may signal the pid once the child is reaped
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    signal.pthread_sigmask(signal.SIG_BLOCK, _STOP_SIGNALS | {signal.SIGALRM})
+    # ru_maxrss includes the memory of the interpreter the child was forked from,
+    # so peak RSS is an upper bound that never goes below a few megabytes
+    _, status, usage = os.wait4(pid, 0)
+    wall = time.monotonic() - start
+    # Processes left behind by the command must not outlive it
+    _kill_group(pid)
+
+    cpu_time = usage.ru_utime + usage.ru_stime
+    if timed_out:
+        retcode = _TIMEOUT_RETCODE
+    elif os.WIFSIGNALED(status):
+        retcode = 128 + os.WTERMSIG(status)
+    else:
+        retcode = os.WEXITSTATUS(status)
+
+    with open(stats_path, "w") as f:
+        json.dump({
+            "retcode": retcode,
+            "cpu_time": cpu_time,
+            "wall_time": wall,
+            "max_rss_kb": usage.ru_maxrss,
+            "limit": _limit_hit(status, cpu_time, limits, timed_out),
+        }, f)
+
+    sys.exit(retcode)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,144 @@
 import json
 import os
+import sqlite3
 
 from copy import deepcopy
+from threading import Lock
 
 class ReviewStorage:
-    def __init__(self, path):
+    """Reviews are kept in a JSON snapshot plus a journal of JSON lines appended after it.
+
+    Every change is a single appended journal record, and the journal is folded into the
+    snapshot every compact_every records, so saving a review costs the same regardless of
+    how many reviews there are. A record torn by a crash is the last line of the journal
+    and is ignored on load. Results graded in batch mode have a snapshot of their own.
+    """
+    def __init__(self, path, compact_every=100):
         self.path = path
-        if os.path.exists(self.path):
-            with open(self.path) as f:
-                self.data = json.load(f)
+        self.fingerprints_path = f"{path}.fingerprints"
+        self.results_path = f"{path}.results"
+        self.journal_path = f"{path}.journal"
+        self.compact_every = compact_every
+        self.lock = Lock()
+        self.journal = None
+        self.journal_records = 0
+        self._data = None
+        self._fingerprints = None
+        self._results = None
+
+    @staticmethod
+    def _load(path):
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+        return {}
+
+    def _ensure_loaded(self):
+        if self._data is not None:
+            return
+        self._data = self._load(self.path)
+        self._fingerprints = self._load(self.fingerprints_path)
+        self._results = self._load(self.results_path)
+
+        if os.path.exists(self.journal_path):
+            valid_size = 0
+            with open(self.journal_path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    self._apply_record(record)
+                    self.journal_records += 1
+                    valid_size += len(line)
+
+            # Drop a torn record, so that new records are not appended to it
+            if os.path.getsize(self.journal_path) != valid_size:
+                os.truncate(self.journal_path, valid_size)
+
+        self.journal = open(self.journal_path, "a")
+
+    @property
+    def data(self):
+        self._ensure_loaded()
+        return self._data
+
+    @property
+    def fingerprints(self):
+        self._ensure_loaded()
+        return self._fingerprints
+
+    @property
+    def results(self):
+        self._ensure_loaded()
+        return self._results
+
+    def _apply_record(self, record):
+        student_id, tag = record["student_id"], record["tag"]
+        if record["op"] == "add":
+            self._data.setdefault(student_id, {})[tag] = record["review"]
+            if record.get("fingerprint") is not None:
+                self._fingerprints.setdefault(student_id, {})[tag] = record["fingerprint"]
+            else:
+                self._fingerprints.get(student_id, {}).pop(tag, None)
+        elif record["op"] == "delete":
+            self._data.get(student_id, {}).pop(tag, None)
+            self._fingerprints.get(student_id, {}).pop(tag, None)
+        elif record["op"] == "add_result":
+            self._results.setdefault(student_id, {})[tag] = {"result": record["result"], "fingerprint": record["fingerprint"]}
+        elif record["op"] == "delete_result":
+            self._results.get(student_id, {}).pop(tag, None)
         else:
-            self.data = {}
+            raise ValueError(f"Invalid journal record: {record}")
+
+    def _append(self, record):
+        with self.lock:
+            self._ensure_loaded()
+            self._apply_record(record)
+            self.journal.write(json.dumps(record) + "\n")
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.journal_records += 1
+            if self.journal_records >= self.compact_every:
+                self._compact()
 
-    def _persist(self):
-        with open(self.path, "w") as f:
-            json.dump(self.data, f, indent='\t')
+    @staticmethod
+    def _write_atomically(path, data):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent='\t')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _compact(self):
+        self._write_atomically(self.path, self._data)
+        if self._fingerprints or os.path.exists(self.fingerprints_path):
+            self._write_atomically(self.fingerprints_path, self._fingerprints)
+        if self._results or os.path.exists(self.results_path):
+            self._write_atomically(self.results_path, self._results)
+
+        # Replaying records already in the snapshot is harmless, so a crash before
+        # the truncation below loses nothing
+        self.journal.truncate(0)
+        self.journal.seek(0)
+        self.journal_records = 0
 
     def _has_review(self, student_id, tag):
         return tag is not None and student_id in self.data and tag in self.data[student_id]
 
-    def _add_review(self, student_id, tag, review):
+    def _add_review(self, student_id, tag, review, fingerprint):
         if tag is None:
             return
-        if student_id not in self.data:
-            self.data[student_id] = {}
-        self.data[student_id][tag] = review
-        self._persist()
+        self._append({"op": "add", "student_id": student_id, "tag": tag, "review": review, "fingerprint": fingerprint})
 
     def _delete_review(self, student_id, tag):
         if tag is None:
             return
-        if self.has_review(student_id, tag):
-            del self.data[student_id][tag]
-        self.persist()
+        if self._has_review(student_id, tag):
+            self._append({"op": "delete", "student_id": student_id, "tag": tag})
 
     def _get_reviews(self, tag):
         if tag is None:
@@ -44,6 +150,137 @@ class ReviewStorage:
             return deepcopy(self.data[student_id])
         return self.data[student_id][tag]
 
+    def _get_fingerprint(self, student_id, tag):
+        return self.fingerprints.get(student_id, {}).get(tag)
+
+    def _get_student_reviews(self, student_id):
+        return dict(self.data.get(student_id, {}))
+
+    def _get_tags(self):
+        return sorted({tag for reviews in self.data.values() for tag in reviews})
+
+    def _add_result(self, student_id, tag, result, fingerprint):
+        if tag is None:
+            return
+        self._append({"op": "add_result", "student_id": student_id, "tag": tag, "result": result, "fingerprint": fingerprint})
+
+    def _delete_result(self, student_id, tag):
+        if tag is None:
+            return
+        if tag in self.results.get(student_id, {}):
+            self._append({"op": "delete_result", "student_id": student_id, "tag": tag})
+
+    def _get_result(self, student_id, tag):
+        stored = self.results.get(student_id, {}).get(tag)
+        if stored is None:
+            return None, None
+        return stored["result"], stored["fingerprint"]
+
+
+class SqliteReviewStorage:
+    """Reviews in an SQLite database, indexed by (student_id, tag).
+
+    The database is used in WAL mode, so several grader processes can write to it at once.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS reviews (
+                student_id TEXT NOT NULL,
+                tag TEXT NOT NULL,
+                review TEXT NOT NULL,
+                fingerprint TEXT,
+                PRIMARY KEY (student_id, tag)
+            ) WITHOUT ROWID
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS reviews_tag ON reviews (tag)")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                student_id TEXT NOT NULL,
+                tag TEXT NOT NULL,
+                result TEXT NOT NULL,
+                fingerprint TEXT,
+                PRIMARY KEY (student_id, tag)
+            ) WITHOUT ROWID
+        """)
+
+    def _query(self, sql, *args):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def _has_review(self, student_id, tag):
+        if tag is None:
+            return False
+        return bool(self._query("SELECT 1 FROM reviews WHERE student_id = ? AND tag = ?", student_id, tag))
+
+    def _add_review(self, student_id, tag, review, fingerprint):
+        if tag is None:
+            return
+        self._query("INSERT OR REPLACE INTO reviews (student_id, tag, review, fingerprint) VALUES (?, ?, ?, ?)",
+                    student_id, tag, review, json.dumps(fingerprint) if fingerprint is not None else None)
+
+    def _delete_review(self, student_id, tag):
+        if tag is None:
+            return
+        self._query("DELETE FROM reviews WHERE student_id = ? AND tag = ?", student_id, tag)
+
+    def _get_reviews(self, tag):
+        if tag is None:
+            reviews = {}
+            for student_id, tag, review in self._query("SELECT student_id, tag, review FROM reviews"):
+                reviews.setdefault(student_id, {})[tag] = review
+            return reviews
+        return dict(self._query("SELECT student_id, review FROM reviews WHERE tag = ?", tag))
+
+    def _get_review(self, student_id, tag):
+        if tag is None:
+            reviews = self._get_student_reviews(student_id)
+            if not reviews:
+                raise KeyError(student_id)
+            return reviews
+        rows = self._query("SELECT review FROM reviews WHERE student_id = ? AND tag = ?", student_id, tag)
+        if not rows:
+            raise KeyError((student_id, tag))
+        return rows[0][0]
+
+    def _get_fingerprint(self, student_id, tag):
+        rows = self._query("SELECT fingerprint FROM reviews WHERE student_id = ? AND tag = ?", student_id, tag)
+        if not rows or rows[0][0] is None:
+            return None
+        return json.loads(rows[0][0])
+
+    def _get_student_reviews(self, student_id):
+        return dict(self._query("SELECT tag, review FROM reviews WHERE student_id = ?", student_id))
+
+    def _get_tags(self):
+        return [tag for tag, in self._query("SELECT DISTINCT tag FROM reviews ORDER BY tag")]
+
+    def _add_result(self, student_id, tag, result, fingerprint):
+        if tag is None:
+            return
+        self._query("INSERT OR REPLACE INTO results (student_id, tag, result, fingerprint) VALUES (?, ?, ?, ?)",
+                    student_id, tag, result, json.dumps(fingerprint) if fingerprint is not None else None)
+
+    def _delete_result(self, student_id, tag):
+        if tag is None:
+            return
+        self._query("DELETE FROM results WHERE student_id = ? AND tag = ?", student_id, tag)
+
+    def _get_result(self, student_id, tag):
+        rows = self._query("SELECT result, fingerprint FROM results WHERE student_id = ? AND tag = ?", student_id, tag)
+        if not rows:
+            return None, None
+        result, fingerprint = rows[0]
+        return result, json.loads(fingerprint) if fingerprint is not None else None
+
+
+_backends = {
+    "sqlite": SqliteReviewStorage,
+}
+
 
 _instance = None
 
@@ -55,19 +292,28 @@ def _get_instance():
     return _instance
 
 
-def init_storage(path):
+def init_storage(path, compact_every=100):
+    """Initializes the storage from a plain path for the journaled JSON storage,
+    or from a URL like sqlite:///reviews.db to use a different backend"""
     global _instance
     if _instance is not None:
         raise RuntimeError("Review storage already initialized")
-    _instance = ReviewStorage(path)
+
+    scheme, sep, location = path.partition(":///")
+    if sep:
+        if scheme not in _backends:
+            raise ValueError(f"Unknown storage backend: {scheme}")
+        _instance = _backends[scheme](location)
+    else:
+        _instance = ReviewStorage(path, compact_every)
 
 
 def has_review(student_id, tag):
     return _get_instance()._has_review(student_id, tag)
 
 
-def add_review(student_id, tag, review):
-    _get_instance()._add_review(student_id, tag, review)
+def add_review(student_id, tag, review, fingerprint=None):
+    _get_instance()._add_review(student_id, tag, review, fingerprint)
 
 
 def delete_review(student_id, tag):
@@ -80,3 +326,23 @@ def get_reviews(tag=None):
 def get_review(student_id, tag=None):
     return _get_instance()._get_review(student_id, tag)
 
+def get_fingerprint(student_id, tag):
+    return _get_instance()._get_fingerprint(student_id, tag)
+
+def get_student_reviews(student_id):
+    return _get_instance()._get_student_reviews(student_id)
+
+def get_tags():
+    return _get_instance()._get_tags()
+
+
+def add_result(student_id, tag, result, fingerprint=None):
+    """Stores a serialized Result graded in batch mode, to be reviewed later"""
+    _get_instance()._add_result(student_id, tag, result, fingerprint)
+
+def delete_result(student_id, tag):
+    _get_instance()._delete_result(student_id, tag)
+
+def get_result(student_id, tag):
+    """The serialized Result stored for the student and its fingerprint, or (None, None)"""
+    return _get_instance()._get_result(student_id, tag)
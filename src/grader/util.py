@@ -1,14 +1,21 @@
-import os
+import json
 import re
+import shlex
 import tempfile
 
 from plumbum import local
+from plumbum.path.utils import copy
 
 from elftools.elf.elffile import ELFFile
 from elftools.elf.sections import SymbolTableSection
 from elftools.elf.enums import ENUM_ST_INFO_TYPE
 
-from functools import lru_cache
+from collections import OrderedDict
+from threading import Lock
+
+from grader.cache import get_cache, hash_key
+
+import grader.profiling as profiling
 
 
 def camel_to_snake_case(s):
@@ -29,112 +36,190 @@ def create_file(path, contents, mode="w", **kwargs):
     return f
 
 
-#TODO(mrkastep): fix lines like "void f(int /*param*/) { // other comment"
+# Comments are removed by the tokenizer, so lines like
+# "void f(int /*param*/) { // other comment" and comment markers in strings are handled
 def get_c_without_comments(f):
-    lines = f.readlines()
-
-    res = []
-    in_comment = False
-
-    for l in lines:
-        l = l.strip()
-        if not in_comment:
-            line_comment = l.find("//")
-            if line_comment != -1:
-                res.append(l[:line_comment])
-                continue
-
-        cur = ""
-        while True:
-            if not in_comment:
-                tag = l.find("/*")
-                if tag != -1:
-                    in_comment = True
-                    cur = cur + l[:tag]
-                    l = l[tag + 2:]
-                    continue
-                cur = cur + l
-                break
-            else:
-                tag = l.find("*/")
-                if tag != -1:
-                    in_comment = False
-                    l = l[tag + 2:]
-                    continue
-                break
-        res.append(cur)
-
-    return "\n".join(res)
+    return "\n".join(l.strip() for l in f.lexical_model().code_lines)
 
 
 def get_object_file_name(source_name):
     return source_name.__class__(re.sub("\.[^\.]*$", ".o", source_name))
 
 
-def get_object_path(source_path, machine=None, session=None):
-    assert source_path.name.endswith(".c")
-    assert machine is None and session is None or machine is not None and session is not None
+def _get_local_headers(source_path, contents):
+    headers = []
+    for name in re.findall(rb'^\s*#\s*include\s*"([^"]+)"', contents, re.MULTILINE):
+        header_path = source_path.dirname / name.decode()
+        if header_path.exists():
+            headers.append(header_path)
+    return headers
 
-    obj_path = get_object_file_name(source_path)
 
-    messages = []
+def get_object_key(source_path, machine=None, compiler="gcc", cflags=""):
+    with open(source_path, "rb") as f:
+        contents = f.read()
 
-    try:
-        if machine is None:
-            gcc = local["gcc"]
-            gcc("-o", obj_path, "-c", source_path)
-        else:
-            with machine.tempdir() as tempdir:
-                rem_source_path = tempdir / "src.c"
-                rem_obj_path = tempdir / "src.o"
-                copy(source_path, rem_source_path)
-                session.run(f"cd {tempdir}")
-                session.run("gcc -o src.o -c src.c")
-                copy(rem_obj_path, obj_path)
-    except:
-        raise RuntimeError(f"{source_path.name}: compilation failed")
+    # Object files also depend on the project headers the source includes
+    headers = [(h.name, h.read(mode="rb")) for h in _get_local_headers(source_path, contents)]
+
+    target = getattr(machine, "host", "local") if machine is not None else "local"
+    return hash_key(contents, repr(headers).encode(), compiler, cflags, target)
+
+
+def get_object_path(source_path, machine=None, session=None, compiler="gcc", cflags=""):
+    """Returns the path to the object file for the source, compiling it only if the
+    object cache has no entry for the same source contents, compiler and flags.
+    The returned file belongs to the cache and must not be modified or removed.
+    """
+    assert source_path.name.endswith(".c")
+    assert machine is None and session is None or machine is not None and session is not None
 
-    return obj_path
+    key = get_object_key(source_path, machine, compiler, cflags)
+    objects = get_cache("objects")
 
+    obj_path = objects.get_path(key)
+    if obj_path is not None:
+        return local.path(obj_path)
 
-@lru_cache(maxsize=10)
-def get_symbols(source_path, machine=None, session=None):
-    obj_path = get_object_path(source_path, machine, session)
+    with tempfile.TemporaryDirectory() as build_dir:
+        build_path = local.path(build_dir) / "src.o"
+        try:
+            if machine is None:
+                with profiling.command_span(f"{compiler} {cflags} -c {source_path.name}"):
+                    local[compiler](*cflags.split(), "-o", build_path, "-c", source_path)
+            else:
+                with machine.tempdir() as tempdir:
+                    rem_source_path = tempdir / source_path.name
+                    rem_obj_path = tempdir / "src.o"
+                    copy(source_path, rem_source_path)
+                    for header_path in _get_local_headers(source_path, source_path.read(mode="rb")):
+                        copy(header_path, tempdir / header_path.name)
+                    # Explicit paths, as changing the directory would change it for the
+                    # rest of the session too
+                    session.run(f"{compiler} {cflags} -o {shlex.quote(str(rem_obj_path))} -c {shlex.quote(str(rem_source_path))}")
+                    copy(rem_obj_path, build_path)
+        except:
+            raise RuntimeError(f"{source_path.name}: compilation failed")
+
+        return local.path(objects.put_file(key, build_path))
+
+
+def _read_object_info(obj_path, source_name):
     with open(obj_path, "rb") as f:
         elf = ELFFile(f)
-        
+
         symtab = elf.get_section_by_name(".symtab")
 
         if not symtab:
-            raise RuntimeError(f"{source_path.name}: .symtab not found")
+            raise RuntimeError(f"{source_name}: .symtab not found")
 
         symbols = {}
 
         for symbol in symtab.iter_symbols():
-            symbols[symbol.name] = symbol["st_info"]
-
-    os.remove(obj_path)
-    return symbols
+            symbols[symbol.name] = {"bind": symbol["st_info"]["bind"], "type": symbol["st_info"]["type"]}
 
-
-@lru_cache(maxsize=10)
-def get_relocations(source_path, machine=None, session=None):
-    obj_path = get_object_path(source_path, machine, session)
-    with open(obj_path, "rb") as f:
-        elf = ELFFile(f)
         # Here we're getting the SHT_RELA type section as it's more common
-        relocations = elf.get_section_by_name(".rela.text")
-        symtab = elf.get_section_by_name(".symtab")
-
-        if not relocations:
-            return set() 
-
-        res = set()
-        for rel in relocations.iter_relocations():
-            symbol = symtab.get_symbol(rel["r_info_sym"])
-            if symbol["st_info"]["type"] == "STT_NOTYPE":
-                res.add(symbol.name)
-
-    os.remove(obj_path)
-    return res
-
+        relocations_section = elf.get_section_by_name(".rela.text")
+
+        relocations = []
+        if relocations_section:
+            for rel in relocations_section.iter_relocations():
+                symbol = symtab.get_symbol(rel["r_info_sym"])
+                if symbol["st_info"]["type"] == "STT_NOTYPE":
+                    relocations.append(symbol.name)
+
+    return {"symbols": symbols, "relocations": relocations}
+
+
+_object_infos = OrderedDict()
+_object_infos_lock = Lock()
+_OBJECT_INFOS_SIZE = 1024
+
+
+def _load_object_info(key, source_path, machine, session, compiler, cflags):
+    infos = get_cache("symbols")
+    data = infos.get(key)
+    if data is not None:
+        return json.loads(data)
+
+    obj_path = get_object_path(source_path, machine, session, compiler, cflags)
+    info = _read_object_info(obj_path, source_path.name)
+    infos.put(key, json.dumps(info).encode())
+    return info
+
+
+def get_object_info(source_path, machine=None, session=None, compiler="gcc", cflags=""):
+    """Symbols and relocations of the object file of the source. Objects built by
+    compile_object with the same compiler and flags are reused instead of compiling
+    the source again."""
+    # The in-memory cache is keyed by the object key alone. It covers the contents, so
+    # edited files are never served stale, and the session used to compile doesn't matter.
+    key = get_object_key(source_path, machine, compiler, cflags)
+    with _object_infos_lock:
+        info = _object_infos.get(key)
+        if info is not None:
+            _object_infos.move_to_end(key)
+            return info
+
+    info = _load_object_info(key, source_path, machine, session, compiler, cflags)
+    with _object_infos_lock:
+        _object_infos[key] = info
+        while len(_object_infos) > _OBJECT_INFOS_SIZE:
+            _object_infos.popitem(last=False)
+    return info
+
+
+def get_symbols(source_path, machine=None, session=None, compiler="gcc", cflags=""):
+    return dict(get_object_info(source_path, machine, session, compiler, cflags)["symbols"])
+
+
+def get_relocations(source_path, machine=None, session=None, compiler="gcc", cflags=""):
+    return set(get_object_info(source_path, machine, session, compiler, cflags)["relocations"])
+
+
+class SymbolMatcher:
+    """Finds occurrences of any of a set of symbol names in a line in one scan,
+    instead of searching for every symbol separately.
+    """
+    _name_chars = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_.$")
+
+    def __init__(self, symbols):
+        self.order = {s: i for i, s in enumerate(symbols)}
+        self.max_len = max(map(len, symbols), default=0)
+        # Longest names first, so that the alternation prefers them over their prefixes
+        names = sorted(symbols, key=len, reverse=True)
+        self.pattern = re.compile("|".join(map(re.escape, names))) if names else None
+        # Calls are found by looking up the name before every parenthesis, which only
+        # works for names made of identifier characters
+        self.irregular = [s for s in symbols if not self._name_chars.issuperset(s)]
+
+    def contains(self, line):
+        return self.pattern is not None and self.pattern.search(line) is not None
+
+    def _suffixes(self, line, end, counts):
+        start = end
+        while start > 0 and end - start < self.max_len and line[start - 1] in self._name_chars:
+            start -= 1
+        for i in range(start, end + 1):
+            name = line[i:end]
+            if name in self.order:
+                counts[name] = counts.get(name, 0) + 1
+
+    def calls(self, line):
+        """Symbols occurring exactly once in line as either "name(" or "name (",
+        in the order they were given in"""
+        direct = {}
+        spaced = {}
+        p = line.find("(")
+        while p != -1:
+            self._suffixes(line, p, direct)
+            if p > 0 and line[p - 1] == " ":
+                self._suffixes(line, p - 1, spaced)
+            p = line.find("(", p + 1)
+
+        for s in self.irregular:
+            direct[s] = line.count(f"{s}(")
+            spaced[s] = line.count(f"{s} (")
+
+        found = {s for s in direct if direct[s] == 1} | {s for s in spaced if spaced[s] == 1}
+        return sorted(found, key=self.order.get)
@@ -0,0 +1,72 @@
+import shlex
+
+from contextlib import contextmanager
+from enum import Enum
+from threading import Lock
+
+
+class WorkspaceMode(Enum):
+    SHARED = 1
+    SNAPSHOT = 2
+
+
+def make_tempdir(machine):
+    return machine.path(machine["mktemp"]("-d").strip())
+
+
+class Workspace:
+    """Copy of the project files on a machine, materialized once per project and shared by
+    all machine rules applied to it. Rules that modify their work directory get a
+    copy-on-write snapshot of it instead.
+    """
+    def __init__(self, machine_pool, copy_files):
+        self.machine_pool = machine_pool
+        self.copy_files = copy_files
+        self.path = None
+        self.lock = Lock()
+
+    def _materialize(self, conn):
+        with self.lock:
+            if self.path is None:
+                path = make_tempdir(conn.machine) / "project"
+                path.mkdir()
+                self.copy_files(conn, path)
+                self.path = path
+        return self.path
+
+    @contextmanager
+    def checkout(self, conn, mode):
+        path = self._materialize(conn)
+        if mode == WorkspaceMode.SHARED:
+            yield path
+            return
+
+        snapshot_path = make_tempdir(conn.machine) / "project"
+        src, dst = shlex.quote(str(path)), shlex.quote(str(snapshot_path))
+        # Copy-on-write clones where the file system supports them, cp without --reflink
+        # (e.g. BSD) falls back to a plain copy
+        conn.session.run(f"cp -a --reflink=auto {src} {dst} 2>/dev/null || {{ rm -rf {dst}; cp -a {src} {dst}; }}")
+        try:
+            yield snapshot_path
+        finally:
+            conn.session.run(f"rm -rf {shlex.quote(str(snapshot_path.dirname))}")
+
+    def close(self):
+        if self.path is None:
+            return
+        with self.machine_pool.lease() as conn:
+            conn.session.run(f"rm -rf {shlex.quote(str(self.path.dirname))}")
+        self.path = None
+
+
+def get_workspace(project, target, machine_pool, files_to_copy, copy_files):
+    """Workspace with the files of target, the project itself or one of its modules,
+    shared by all rules of the project using the same machine pool"""
+    def create():
+        workspace = Workspace(machine_pool, copy_files)
+        project.on_close(workspace.close)
+        return workspace
+
+    scope = None if target is project else (type(target).__name__, target.name)
+    key = ("workspace", id(machine_pool), tuple(files_to_copy or ()), scope)
+    return project.cached(key, create)
@@ -0,0 +1,69 @@
+import os
+import time
+
+import grader.cache as cache
+
+
+def setup_cache(tmp_path, max_size_mb):
+    cache.init_cache({"path": str(tmp_path), "max_size_mb": max_size_mb})
+
+
+def teardown_function():
+    cache.init_cache({"path": ".grader_cache", "max_size_mb": 512})
+
+
+def age(path, seconds):
+    # Entries are evicted by mtime, which a fast test would leave equal
+    t = time.time() - seconds
+    os.utime(path, (t, t))
+
+
+def test_get_and_put(tmp_path):
+    setup_cache(tmp_path, 1)
+    objects = cache.get_cache("objects")
+    assert objects.get("missing") is None
+    path = objects.put("key", b"data")
+    assert objects.get("key") == b"data"
+    assert objects.get_path("key") == path
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    setup_cache(tmp_path, 1)
+    objects = cache.get_cache("objects")
+    chunk = b"x" * (300 * 1024)
+    for i, key in enumerate(["a", "b", "c"]):
+        age(objects.put(key, chunk), 100 - i)
+    # Reading an entry makes it the most recently used one
+    assert objects.get("a") == chunk
+
+    objects.put("d", chunk)
+    assert objects.get("b") is None
+    assert [objects.get(k) is not None for k in ["a", "c", "d"]] == [True, True, True]
+
+
+def test_namespaces_share_the_size_limit(tmp_path):
+    setup_cache(tmp_path, 1)
+    chunk = b"x" * (300 * 1024)
+    namespaces = [cache.get_cache(n) for n in ["objects", "results", "blobs", "symbols"]]
+    for i, c in enumerate(namespaces):
+        age(c.put("key", chunk), 100 - i)
+
+    total = sum(e.stat().st_size for n in os.scandir(tmp_path) for e in os.scandir(n.path))
+    assert total <= 1024 * 1024
+    # The oldest entry went, whichever namespace it was in
+    assert namespaces[0].get("key") is None
+    assert namespaces[3].get("key") == chunk
+
+
+def test_existing_entries_count_towards_the_limit(tmp_path):
+    setup_cache(tmp_path, 1)
+    chunk = b"x" * (400 * 1024)
+    age(cache.get_cache("objects").put("old", chunk), 100)
+
+    # Another run starts with the entries left by the previous one
+    setup_cache(tmp_path, 1)
+    results = cache.get_cache("results")
+    results.put("a", chunk)
+    results.put("b", chunk)
+    assert cache.get_cache("objects").get("old") is None
+    assert results.get("a") == chunk and results.get("b") == chunk
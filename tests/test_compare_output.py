@@ -0,0 +1,59 @@
+from grader.rules.test import compare_output
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_equal_in_any_chunking():
+    expected = b"1\n22\n333\n"
+    for size in range(1, len(expected) + 1):
+        assert compare_output(chunked(expected, size), expected) is None
+
+
+def test_mismatch_reports_first_differing_line():
+    expected = b"one\ntwo\nthree\n"
+    for size in range(1, 16):
+        failure = compare_output(chunked(b"one\ntwX\nthree\n", size), expected)
+        assert failure == "diff at line 2: expected 'two', got 'twX'"
+
+
+def test_missing_and_extra_output():
+    assert compare_output([b"one\n"], b"one\ntwo\n") == "diff at line 2: expected 'two', got ''"
+    assert compare_output([b"one\ntwo\n"], b"one\n") == "diff at line 2: expected '', got 'two'"
+    assert compare_output([], b"") is None
+
+
+def test_reading_stops_at_first_difference():
+    read = []
+
+    def chunks():
+        for chunk in [b"a\n", b"b\n", b"c\n", b"d\n"]:
+            read.append(chunk)
+            yield chunk
+
+    assert compare_output(chunks(), b"a\nX\nc\nd\n") is not None
+    assert read == [b"a\n", b"b\n"]
+
+
+def test_limit():
+    expected = b"y\n" * 10
+    assert compare_output(chunked(expected, 4), expected, limit=len(expected)) is None
+    assert compare_output(chunked(expected + b"y\n", 4), expected, limit=len(expected)) \
+        == f"output exceeds {len(expected)} bytes"
+
+
+def test_limit_stops_endless_output():
+    def endless():
+        while True:
+            yield b"y\n" * 512
+
+    # Output matching the expected one up to the limit still ends there
+    assert compare_output(endless(), b"y\n" * 4096, limit=4096) == "output exceeds 4096 bytes"
+
+
+def test_line_endings_are_compared():
+    # Outputs are compared byte for byte, so CRLF only matches CRLF
+    assert compare_output([b"a\r\nb\r\n"], b"a\r\nb\r\n") is None
+    assert compare_output([b"a\r\nb\r\n"], b"a\nb\n") is not None
+    assert compare_output([b"a\nb\n"], b"a\r\nb\r\n") is not None
@@ -0,0 +1,73 @@
+import gc
+
+from plumbum import local
+
+import grader.project as project
+from grader.project import File, FileType, set_content_budget
+
+
+def teardown_function():
+    set_content_budget(256 * 1024 * 1024)
+
+
+def make_files(tmp_path, count, size):
+    files = []
+    for i in range(count):
+        (tmp_path / f"f{i}.c").write_text(f"{i}" * size)
+        files.append(File(f"f{i}.c", FileType.SOURCE, local.path(str(tmp_path))))
+    return files
+
+
+def test_least_recently_used_files_are_dropped(tmp_path):
+    set_content_budget(250 * 1024)
+    files = make_files(tmp_path, 3, 100 * 1024)
+    files[0].read()
+    files[1].read()
+    # files[0] becomes the most recently used one
+    files[0].read()
+    files[2].read()
+
+    assert files[1].contents is None
+    assert files[0].contents is not None and files[2].contents is not None
+    assert project._budget.size <= 250 * 1024
+    # Dropped files are read again on next use
+    assert files[1].read() == "1" * 100 * 1024
+
+
+def test_derived_data_counts_towards_the_budget(tmp_path):
+    set_content_budget(10 ** 9)
+    f, = make_files(tmp_path, 1, 10 * 1024)
+    f.read()
+    read_size = project._budget.size
+    f.lexical_model()
+    f.line_offsets()
+    assert project._budget.size > read_size
+    assert project._budget.size == f._memory_size()
+
+    f.close()
+    assert f.contents is None and f.model is None
+    assert project._budget.size == 0
+
+
+def test_mapped_files_are_dropped(tmp_path):
+    set_content_budget(150 * 1024)
+    files = make_files(tmp_path, 2, 100 * 1024)
+    view = files[0].view()
+    files[1].view()
+
+    assert files[0].map is None
+    # A view taken before stays usable
+    assert bytes(view[:3]) == b"000"
+    view.release()
+    assert bytes(files[0].view()[:3]) == b"000"
+
+
+def test_collected_files_are_forgotten(tmp_path):
+    set_content_budget(10 ** 9)
+    files = make_files(tmp_path, 2, 10 * 1024)
+    for f in files:
+        f.read()
+    del files, f
+    gc.collect()
+    assert project._budget.size == 0
+    assert len(project._budget.entries) == 0
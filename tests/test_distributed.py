@@ -0,0 +1,134 @@
+import multiprocessing
+import os
+import time
+
+from grader.distributed import Coordinator, WorkQueue, run_worker
+from grader.result import Result
+
+
+def drain(queue):
+    results = {}
+    while not queue.results.empty():
+        student_id, result = queue.results.get()
+        results[student_id] = Result.from_json(result)
+    return results
+
+
+def graded(penalty):
+    res = Result(need_review=False)
+    res.penalty = penalty
+    return res.to_json()
+
+
+def test_students_are_handed_out_once():
+    queue = WorkQueue(["a", "b"], {})
+    assert queue.take("w1") == "a"
+    assert queue.take("w2") == "b"
+    queue.complete("w1", "a", graded(1))
+    queue.complete("w2", "b", graded(2))
+    assert queue.take("w1") is None
+    assert {s: r.penalty for s, r in drain(queue).items()} == {"a": 1, "b": 2}
+
+
+def test_expired_lease_is_handed_out_again():
+    queue = WorkQueue(["a"], {}, lease_timeout=0.05, steal_after=60)
+    assert queue.take("w1") == "a"
+    time.sleep(0.1)
+    assert queue.take("w2") == "a"
+    assert queue.failures["a"] == 1
+    assert "w1" in queue.errors["a"]
+
+    # The late result of the first worker still counts, as nobody else finished
+    queue.complete("w1", "a", graded(1))
+    queue.complete("w2", "a", graded(2))
+    assert {s: r.penalty for s, r in drain(queue).items()} == {"a": 1}
+
+
+def test_heartbeats_extend_the_lease():
+    queue = WorkQueue(["a", "b"], {}, lease_timeout=0.1, steal_after=60)
+    assert queue.take("w1") == "a"
+    for _ in range(3):
+        time.sleep(0.05)
+        queue.heartbeat("w1")
+    assert queue.take("w2") == "b"
+    assert queue.failures["a"] == 0
+
+
+def test_failed_student_is_retried_up_to_max_attempts():
+    queue = WorkQueue(["a"], {}, max_attempts=2)
+    assert queue.take("w1") == "a"
+    queue.fail("w1", "a", "error 1")
+    assert queue.take("w1") == "a"
+    queue.fail("w1", "a", "error 2")
+
+    assert queue.take("w1") is None
+    res = drain(queue)["a"]
+    assert res.need_review
+    assert "failed 2 times" in res.messages[0] and "error 2" in res.messages[0]
+
+
+def test_straggler_is_stolen_and_duplicate_completion_ignored():
+    queue = WorkQueue(["a"], {}, steal_after=0)
+    assert queue.take("w1") == "a"
+    # Nothing left to hand out, so an idle worker grades the same student
+    assert queue.take("w2") == "a"
+
+    queue.complete("w2", "a", graded(2))
+    queue.complete("w1", "a", graded(1))
+    assert {s: r.penalty for s, r in drain(queue).items()} == {"a": 2}
+    assert queue.take("w3") is None
+
+
+def test_students_are_not_stolen_twice_or_by_their_worker():
+    queue = WorkQueue(["a"], {}, steal_after=0)
+    assert queue.take("w1") == "a"
+    assert queue._straggler("w1") is None
+    assert queue.take("w2") == "a"
+    assert queue._straggler("w3") is None
+
+
+def test_failure_of_the_stealing_worker_keeps_the_original():
+    queue = WorkQueue(["a"], {}, steal_after=0)
+    queue.take("w1")
+    queue.take("w2")
+    queue.fail("w2", "a", "error")
+    assert not queue.pending
+    queue.complete("w1", "a", graded(1))
+    assert {s: r.penalty for s, r in drain(queue).items()} == {"a": 1}
+
+
+def setup_worker(settings):
+    def grade(student_id):
+        # The first worker to grade s3 fails, whoever it is
+        if student_id == "s3":
+            try:
+                os.mkdir(settings["failed_marker"])
+            except FileExistsError:
+                pass
+            else:
+                raise RuntimeError("worker error")
+        res = Result(need_review=False)
+        res.penalty = settings["penalty"]
+        return res
+    return grade
+
+
+def test_several_workers(tmp_path):
+    students = [f"s{i}" for i in range(20)]
+    settings = {"lease_timeout": 5, "penalty": 3, "failed_marker": str(tmp_path / "failed")}
+    queue = WorkQueue(students, settings, lease_timeout=5)
+    address = Coordinator(None, {}, {"authkey": "test"})._start_server(queue)
+
+    # Workers run in processes of their own, like the ones the coordinator starts
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_worker, args=(address, "test", setup_worker)) for _ in range(3)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join(timeout=60)
+        assert w.exitcode == 0
+
+    results = drain(queue)
+    assert sorted(results) == sorted(students)
+    assert all(r.penalty == 3 for r in results.values())
+    assert queue.failures["s3"] == 1
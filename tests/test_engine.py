@@ -0,0 +1,44 @@
+import asyncio
+import sys
+
+from grader.engine import Engine, run_subprocess
+import grader.engine as engine
+
+
+def setup_function():
+    engine.init_engine({"max_subprocesses": 1})
+
+
+def teardown_function():
+    engine.init_engine({"max_subprocesses": 32})
+
+
+def test_subprocesses_wait_for_the_limit():
+    async def run_all():
+        return await asyncio.gather(*(run_subprocess([sys.executable, "-c", f"print({i})"]) for i in range(4)))
+
+    results = engine.get_engine().run(run_all())
+    assert results == [(0, f"{i}\n", "") for i in range(4)]
+
+
+def test_primitives_created_for_the_loop():
+    e = Engine(1)
+    try:
+        queue = e.call(asyncio.Queue)
+
+        async def consume():
+            # Waits for the items put below, which needs the queue to belong to this loop
+            return [await queue.get() for _ in range(3)]
+
+        async def produce():
+            for i in range(3):
+                await asyncio.sleep(0.01)
+                queue.put_nowait(i)
+
+        async def both():
+            items, _ = await asyncio.gather(consume(), produce())
+            return items
+
+        assert e.run(both()) == [0, 1, 2]
+    finally:
+        e.close()
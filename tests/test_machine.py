@@ -0,0 +1,37 @@
+from plumbum import local
+
+from grader.machine import MachinePool, get_remote_machine_pool
+
+
+def test_session_is_kept_and_reset_between_leases():
+    pool = MachinePool(lambda: local, 1)
+    with pool.lease() as conn:
+        session = conn.session
+        conn.session.run("cd / && export GRADER_TEST_VAR=1 && export PATH=/nonexistent")
+
+    with pool.lease() as conn:
+        assert conn.session is session
+        _, out, _ = conn.session.run("pwd; echo \"[$GRADER_TEST_VAR]\"; echo \"$PATH\"")
+    cwd, var, path = out.splitlines()
+    assert cwd == local.env.home
+    assert var == "[]"
+    assert path == local.env["PATH"]
+
+
+def test_session_is_reopened_after_a_failed_lease():
+    pool = MachinePool(lambda: local, 1)
+    try:
+        with pool.lease() as conn:
+            session = conn.session
+            raise ValueError()
+    except ValueError:
+        pass
+
+    with pool.lease() as conn:
+        assert conn.session is not session
+        assert conn.session.run("echo ok")[1] == "ok\n"
+
+
+def test_pools_per_size():
+    assert get_remote_machine_pool("host", "user", "key", 1) is get_remote_machine_pool("host", "user", "key", 1)
+    assert get_remote_machine_pool("host", "user", "key", 2).size == 2
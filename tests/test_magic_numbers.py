@@ -0,0 +1,105 @@
+import re
+
+from plumbum import local
+
+from grader.project import Project
+from grader.rules.rule import construct_rule
+
+
+def legacy_clean_code(text):
+    # The comment removal the rule used before the tokenizer
+    res = []
+    in_comment = False
+    for l in text.split("\n"):
+        l = l.strip()
+        if not in_comment:
+            line_comment = l.find("//")
+            if line_comment != -1:
+                res.append(l[:line_comment])
+                continue
+
+        cur = ""
+        while True:
+            if not in_comment:
+                tag = l.find("/*")
+                if tag != -1:
+                    in_comment = True
+                    cur = cur + l[:tag]
+                    l = l[tag + 2:]
+                    continue
+                cur = cur + l
+                break
+            else:
+                tag = l.find("*/")
+                if tag != -1:
+                    in_comment = False
+                    l = l[tag + 2:]
+                    continue
+                break
+        res.append(cur)
+    return res
+
+
+def legacy_messages(name, text, whitelist=(0, 1), skip_markers=()):
+    messages = []
+    for i, l in enumerate(legacy_clean_code(text), 1):
+        if any(l.count(m) > 0 for m in skip_markers) or l.strip().startswith("#define"):
+            continue
+        for magic in map(int, re.findall("(?<=[^a-zA-Z0-9_])[0-9]+", l)):
+            if magic not in whitelist:
+                messages.append(f"{name}: Magic number {magic} at line {i}")
+    return messages
+
+
+SOURCES = {
+    "literals.c": """#include <stdio.h>
+#define SIZE 100
+#if LEVEL > 3
+int table[SIZE] = { 2, 0x1F, 0XA0u, 017, 1e10, 2.5f, .75, 3UL };
+#endif
+char c = '7', d = '\\x41';
+const char *s = "error 404: line 9";
+int a1 = 12, b_2 = x3 + 22;
+42;
+    77 + 8;
+""",
+    "comments.c": """/* 13 in a comment
+   14 and more */
+int f(int x) { // 15
+    return x * 16; /* 17 */ + 18;
+}
+/* 19 */ int g(void) { return 20; }
+// NOLINT 21
+int h(void) { return 22; } // NOLINT
+""",
+    "calc.c": """int main(void)
+{
+    int values[10];
+    for (int i = 0; i < 10; i++) {
+        values[i] = i * i % 7 - 3;
+    }
+    printf("%d %5.2f\\n", values[9], 1.0 / 3);
+    return values[2] > 4 ? 2 : 0;
+}
+""",
+}
+
+
+def test_same_messages_as_the_line_regex(tmp_path):
+    for name, text in SOURCES.items():
+        (tmp_path / name).write_text(text)
+    project_config = {"modules": [{"source": name} for name in SOURCES]}
+    rule_config = {"whitelist": [0, 1, 2], "skip_markers": ["NOLINT"], "per_magic_penalty": 1}
+
+    with Project(project_config, local.path(str(tmp_path))) as project:
+        res = construct_rule({"name": "magic_numbers", "config": rule_config}).apply(project)
+
+    expected = []
+    penalty = 0
+    for name, text in SOURCES.items():
+        messages = legacy_messages(name, text, [0, 1, 2], ["NOLINT"])
+        expected += messages
+        # Every file is penalized once per distinct magic number
+        penalty += len({m.split()[3] for m in messages})
+    assert res.messages == expected
+    assert res.penalty == penalty
@@ -0,0 +1,43 @@
+from plumbum import local
+
+import grader.cache as cache
+import grader.profiling as profiling
+from grader.project import Project
+from grader.rules.rule import construct_rule
+
+
+SOURCE = """static int helper(void) { return 2; }
+int main(void) { return helper(); }
+"""
+
+
+def compilations(cflags, static_symbols_config, tmp_path):
+    cache.init_cache({"path": str(tmp_path / "cache"), "results": False})
+    project_dir = tmp_path / "project"
+    project_dir.mkdir()
+    # Symbols of sources seen before are kept in memory, whatever the cache directory
+    (project_dir / "main.c").write_text(f"// {tmp_path.name}\n{SOURCE}")
+    project_config = {"modules": [{"source": "main.c"}]}
+
+    profiling.init_profiler(True)
+    try:
+        with Project(project_config, local.path(str(project_dir))) as project:
+            construct_rule({"name": "compilation", "config": {"modules": ["main"], "cflags": cflags, "fail_penalty": 10}}).apply(project)
+            res = construct_rule({"name": "static_symbols", "config": {"whitelist": {"main": ["main"]},
+                                                                        **static_symbols_config}}).apply(project)
+        spans = profiling.drain()
+    finally:
+        profiling.init_profiler(False)
+
+    assert res.messages == []
+    return [s["name"] for s in spans if s["category"] == "subprocess" and " -c " in s["name"]]
+
+
+def test_objects_built_with_the_same_flags_are_reused(tmp_path):
+    names = compilations("-std=c99 -O0", {"cflags": "-std=c99 -O0"}, tmp_path)
+    assert names == ["gcc -std=c99 -O0 -c -o main.o main.c"]
+
+
+def test_objects_built_with_other_flags_are_not(tmp_path):
+    names = compilations("-std=c99 -O0", {}, tmp_path)
+    assert names == ["gcc -std=c99 -O0 -c -o main.o main.c", "gcc  -c main.c"]
@@ -0,0 +1,97 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import uuid
+
+from grader.sandbox import SandboxLimits, sandbox_argv
+
+
+# Prints a line and then spins in a child of its own and in itself, like a test program
+# whose output was rejected
+PROGRAM = """
+import os, sys
+if os.fork():
+    print("started", flush=True)
+while True:
+    pass
+"""
+
+
+def start(tmp_path, marker):
+    limits = SandboxLimits({"python": sys.executable, "wall_time": 30})
+    stats_path = tmp_path / "stats.json"
+    argv = sandbox_argv(limits, [sys.executable, "-c", PROGRAM, marker], stats_path)
+    return subprocess.Popen(argv, stdout=subprocess.PIPE), stats_path
+
+
+def running(marker):
+    pids = []
+    for pid in os.listdir("/proc"):
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                cmdline = f.read().split(b"\0")
+            with open(f"/proc/{pid}/stat") as f:
+                zombie = f.read().rsplit(")", 1)[1].split()[0] == "Z"
+        except (FileNotFoundError, ProcessLookupError, NotADirectoryError):
+            continue
+        if marker.encode() in cmdline and not zombie:
+            pids.append(pid)
+    return pids
+
+
+def wait_gone(marker):
+    deadline = time.monotonic() + 5
+    while running(marker) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return running(marker)
+
+
+def test_stopping_kills_the_program(tmp_path):
+    marker = uuid.uuid4().hex
+    proc, stats_path = start(tmp_path, marker)
+    assert proc.stdout.readline() == b"started\n"
+    proc.terminate()
+    assert proc.wait(timeout=5) == 128 + signal.SIGKILL
+    proc.stdout.close()
+
+    assert wait_gone(marker) == []
+    with open(stats_path) as f:
+        stats = json.load(f)
+    assert stats["retcode"] == 128 + signal.SIGKILL
+    assert stats["limit"] is None
+
+
+def test_stopping_while_starting_kills_the_program(tmp_path):
+    # Stopped right after the sandbox forked, while the program is being started
+    for _ in range(30):
+        marker = uuid.uuid4().hex
+        proc, stats_path = start(tmp_path, marker)
+        while len(running(marker)) < 2 and proc.poll() is None:
+            pass
+        proc.terminate()
+        proc.wait(timeout=5)
+        proc.stdout.close()
+
+        assert wait_gone(marker) == []
+        assert stats_path.exists()
+        stats_path.unlink()
+
+
+def test_closing_the_output_kills_the_program(tmp_path):
+    marker = uuid.uuid4().hex
+    proc, stats_path = start(tmp_path, marker)
+    assert proc.stdout.readline() == b"started\n"
+    proc.stdout.close()
+    proc.wait(timeout=5)
+
+    assert wait_gone(marker) == []
+    assert stats_path.exists()
+
+
+def test_address_space_is_not_limited_by_default():
+    # Programs built with -fsanitize=address reserve more address space than any sane limit
+    assert "address_space" not in SandboxLimits({}).rlimits()
+    assert SandboxLimits({"memory_mb": 512}).rlimits()["address_space"] == 512 * 1024 * 1024
@@ -0,0 +1,63 @@
+import os
+
+from grader.storage import ReviewStorage
+
+
+def reopen(storage):
+    storage.journal.close()
+    return ReviewStorage(storage.path, storage.compact_every)
+
+
+def test_journal_is_replayed(tmp_path):
+    storage = ReviewStorage(str(tmp_path / "reviews.json"))
+    storage._add_review("jdoe", "hw1", {"penalty": 1}, "f1")
+    storage._add_review("jdoe2", "hw1", {"penalty": 2}, None)
+    storage._add_result("jdoe3", "hw1", "{}", "f3")
+    storage._delete_review("jdoe2", "hw1")
+
+    storage = reopen(storage)
+    assert storage._get_review("jdoe", "hw1") == {"penalty": 1}
+    assert not storage._has_review("jdoe2", "hw1")
+    assert storage._get_fingerprint("jdoe", "hw1") == "f1"
+    assert storage._get_result("jdoe3", "hw1") == ("{}", "f3")
+    assert storage.journal_records == 4
+
+
+def test_truncated_record_is_dropped(tmp_path):
+    storage = ReviewStorage(str(tmp_path / "reviews.json"))
+    storage._add_review("jdoe", "hw1", {"penalty": 1}, None)
+    valid_size = os.path.getsize(storage.journal_path)
+    storage._add_review("jdoe2", "hw1", {"penalty": 2}, None)
+    storage.journal.close()
+
+    # A crash in the middle of writing the last record
+    os.truncate(storage.journal_path, os.path.getsize(storage.journal_path) - 5)
+
+    storage = ReviewStorage(storage.path)
+    assert storage._get_reviews("hw1") == {"jdoe": {"penalty": 1}}
+    assert os.path.getsize(storage.journal_path) == valid_size
+
+    # Records appended after the torn one was dropped are read back
+    storage._add_review("jdoe3", "hw1", {"penalty": 3}, None)
+    storage = reopen(storage)
+    assert storage._get_reviews("hw1") == {"jdoe": {"penalty": 1}, "jdoe3": {"penalty": 3}}
+
+
+def test_unparsable_record_is_dropped(tmp_path):
+    storage = ReviewStorage(str(tmp_path / "reviews.json"))
+    storage._add_review("jdoe", "hw1", {"penalty": 1}, None)
+    storage.journal.write('{"op": "add", "stud\n')
+    storage = reopen(storage)
+    assert storage._get_reviews("hw1") == {"jdoe": {"penalty": 1}}
+    assert storage.journal_records == 1
+
+
+def test_compaction(tmp_path):
+    storage = ReviewStorage(str(tmp_path / "reviews.json"), compact_every=3)
+    for i in range(4):
+        storage._add_review(f"s{i}", "hw1", {"penalty": i}, None)
+    assert storage.journal_records == 1
+    assert os.path.exists(storage.path)
+
+    storage = reopen(storage)
+    assert storage._get_reviews("hw1") == {f"s{i}": {"penalty": i} for i in range(4)}
@@ -0,0 +1,49 @@
+import random
+
+from grader.util import SymbolMatcher
+
+
+SYMBOLS = ["main", "readValue", "read", "ead", "plus", "a.b", "x$y", "_"]
+
+
+def naive_calls(symbols, line):
+    # The check every symbol went through before SymbolMatcher
+    return [s for s in symbols if line.count(f"{s}(") == 1 or line.count(f"{s} (") == 1]
+
+
+def naive_contains(symbols, line):
+    return any(line.count(s) > 0 for s in symbols)
+
+
+def random_line(rng):
+    pieces = SYMBOLS + ["(", " (", ")", " ", ",", "int ", "x", "re", "=", ";", "((", "  "]
+    return "".join(rng.choice(pieces) for _ in range(rng.randint(0, 12)))
+
+
+def test_calls_match_per_symbol_counts():
+    rng = random.Random(0)
+    matcher = SymbolMatcher(SYMBOLS)
+    for _ in range(5000):
+        line = random_line(rng)
+        assert matcher.calls(line) == naive_calls(SYMBOLS, line), line
+
+
+def test_contains_matches_per_symbol_search():
+    rng = random.Random(1)
+    matcher = SymbolMatcher(SYMBOLS)
+    for _ in range(5000):
+        line = random_line(rng)
+        assert matcher.contains(line) == naive_contains(SYMBOLS, line), line
+
+
+def test_repeated_calls():
+    matcher = SymbolMatcher(["read", "readValue"])
+    assert matcher.calls("readValue(readValue(x))") == []
+    assert matcher.calls("readValue(read (x))") == ["read", "readValue"]
+    assert matcher.calls("read(x) + read (y)") == ["read"]
+
+
+def test_no_symbols():
+    matcher = SymbolMatcher([])
+    assert not matcher.contains("main()")
+    assert matcher.calls("main()") == []